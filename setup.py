@@ -37,7 +37,10 @@ setuptools.setup(
     keywords="HLS streaming m3u8 concatenate merge",
     package_dir={"": "src"},
     packages=["caterpillar"],
-    install_requires=["xdgappdirs>=1.4.4.3", "click", "m3u8", "peewee", "requests"],
-    extras_require={"dev": ["black", "flake8", "mypy", "pylint", "pytest"]},
+    install_requires=["xdgappdirs>=1.4.4.3", "click", "peewee", "requests"],
+    extras_require={
+        "dev": ["black", "flake8", "mypy", "pylint", "pytest"],
+        "pyav": ["av"],
+    },
     entry_points={"console_scripts": ["caterpillar=caterpillar.caterpillar:main"]},
 )
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import datetime
 import os
 import pathlib
@@ -10,11 +11,11 @@ import time
 import urllib.parse
 from typing import Any, List, Optional, Sequence, Tuple
 
-import m3u8
 import peewee
 
-from . import download, merge, persistence, variants
+from . import download, live, merge, persistence, pyav, variants
 from .events import EventHook, MergeFinishedEvent, emit_event
+from .playlist import Playlist, Variant, load_playlist
 from .utils import (
     USER_CONFIG_DIR,
     USER_CONFIG_DISABLED,
@@ -278,40 +279,158 @@ def move_to_backup(path: pathlib.Path) -> Optional[pathlib.Path]:
         return None
 
 
+# Resolve m3u8_url from the variant selection cache. A fresh cached
+# selection is used as is; a stale one is revalidated with a conditional
+# GET, and if the master playlist has been modified, it is downloaded to
+# m3u8_file instead.
+#
+# On a cache hit, m3u8_file is written as a master playlist listing only
+# the selected variant (with an absolute URL), so that the rest of the
+# resolution process, and any later attempt to resume the job, sticks to
+# the same selection.
+#
+# Returns (hit, fetch_result), where fetch_result is the result of the
+# HTTP request made, if any. (False, None) indicates a cache miss, and
+# that nothing was downloaded.
+def _resolve_from_variant_cache(
+    m3u8_url: str, m3u8_file: pathlib.Path
+) -> Tuple[bool, Optional[download.PlaylistFetchResult]]:
+    try:
+        cached = persistence.get_variant_selection(m3u8_url)
+    except peewee.PeeweeException:
+        logger.exc_warning("exception when reading cache")
+        return False, None
+    if cached is None:
+        return False, None
+
+    fetched = None
+    if not cached.fresh:
+        logger.info(f"revalidating cached variant selection for {m3u8_url}")
+        fetched = download.fetch_m3u8_file(
+            m3u8_url, m3u8_file, etag=cached.etag, last_modified=cached.last_modified
+        )
+        if fetched is None or fetched.modified:
+            return False, fetched
+        try:
+            persistence.revalidate_variant_selection(
+                m3u8_url, etag=fetched.etag, last_modified=fetched.last_modified
+            )
+        except peewee.PeeweeException:
+            logger.exc_warning("exception when updating cache")
+
+    logger.info(f"using cached variant selection for {m3u8_url}")
+    variant = variants.variant_from_score(cached.variant_url, cached.variant_score)
+    Playlist(variants=[variant]).dump(m3u8_file)
+    return True, fetched
+
+
+# Download the media playlists of candidates (variants of the master
+# playlist at master_url, from best to worst) concurrently, to dest for
+# the best candidate and to sibling files for the rest, and settle on
+# the best one that was successfully downloaded, which is moved to dest.
+#
+# Returns the selected candidate, or None if all downloads failed.
+def _prefetch_variants(
+    master_url: str, candidates: List[Variant], dest: pathlib.Path
+) -> Optional[Variant]:
+    files = [dest] + [
+        dest.with_suffix(f".candidate{rank}{dest.suffix}")
+        for rank in range(2, len(candidates) + 1)
+    ]
+    urls = [urllib.parse.urljoin(master_url, c.uri) for c in candidates]
+    logger.info(f"prefetching {len(candidates)} variant playlists...")
+    with concurrent.futures.ThreadPoolExecutor(len(candidates)) as executor:
+        results = list(executor.map(download.download_m3u8_file, urls, files))
+    selected = None
+    for candidate, file, ok in zip(candidates, files, results):
+        if ok and selected is None:
+            selected = candidate
+            if file != dest:
+                logger.warning(f"falling back to variant {candidate.uri}")
+                os.replace(file, dest)
+        elif ok:
+            file.unlink()
+    return selected
+
+
 # Download m3u8_url to the designated path. If there are variant streams
 # in the m3u8 file, select a variant, resolve the URL, and download to
 # the designated path with variant_suffix appended to the stem of the
 # filename. Repeat this process until there are no longer variant streams.
 #
-# Returns the final resolved url and file path. Returned file path is
-# None if there's an error along the way.
+# Variant selections are cached (see persistence.VariantSelection), so
+# that master playlists seen recently, e.g. earlier in the same batch,
+# are resolved without being downloaded again.
+#
+# If prefetch_variants is greater than 1, the media playlists of that
+# many top variant candidates are downloaded concurrently, and if the
+# best one cannot be downloaded, the next best is used instead.
+#
+# variant_policy is either 'best' (the variant with the highest
+# resolution and bandwidth) or 'probe' (a couple of segments of each
+# variant are downloaded to measure throughput, and the best variant
+# within deadline and bandwidth_budget is selected; see
+# variants.select_probed_variant). Selections by probing depend on the
+# network conditions at the time, so they bypass the cache.
+#
+# Returns the final resolved url, file path, and parsed playlist.
+# Returned file path and playlist are None if there's an error along the
+# way.
 #
 # Naming example:
 #   remote.m3u8 => remote.variant.m3u8 => remote.variant.variant.m3u8 => ...
 def download_m3u8_file_and_resolve_variants(
-    m3u8_url: str, m3u8_file: pathlib.Path, *, variant_suffix=".variant"
-) -> Tuple[str, Optional[pathlib.Path]]:
+    m3u8_url: str,
+    m3u8_file: pathlib.Path,
+    *,
+    variant_suffix=".variant",
+    prefetch_variants: int = 1,
+    variant_policy: str = "best",
+    deadline: float = None,
+    bandwidth_budget: float = None,
+) -> Tuple[str, Optional[pathlib.Path], Optional[Playlist]]:
+    use_cache = variant_policy != "probe"
     while True:
-        if not download.download_m3u8_file(m3u8_url, m3u8_file):
-            logger.error(f"failed to download {m3u8_url}")
-            return m3u8_url, None
+        # An existing m3u8_file is always reused, so that a resumed job
+        # sticks to the same playlist.
+        fetched = None
+        if not m3u8_file.exists():
+            hit, fetched = (
+                _resolve_from_variant_cache(m3u8_url, m3u8_file)
+                if use_cache
+                else (False, None)
+            )
+            if not hit and fetched is None:
+                logger.info(f"downloading {m3u8_url} to {m3u8_file} ...")
+                fetched = download.fetch_m3u8_file(m3u8_url, m3u8_file)
+            if not hit and fetched is None:
+                logger.error(f"failed to download {m3u8_url}")
+                return m3u8_url, None, None
 
         try:
-            m3u8_obj = m3u8.load(str(m3u8_file))
+            m3u8_obj = load_playlist(m3u8_file)
         except Exception:
             logger.exc_error(f"failed to parse {m3u8_file}")
-            return m3u8_url, None
+            return m3u8_url, None, None
 
         if not m3u8_obj.is_variant:
-            return m3u8_url, m3u8_file
-
-        variant_count = len(m3u8_obj.playlists)
-        if variant_count == 0:
-            # This branch shouldn't be reachable.
-            logger.error(f"found 0 variant streams in {m3u8_file}")
-            return m3u8_url, None
-
-        selected_variant = variants.select_variant(m3u8_obj)
+            return m3u8_url, m3u8_file, m3u8_obj
+
+        variant_count = len(m3u8_obj.variants)
+        candidates = variants.rank_variants(m3u8_obj)
+        if variant_policy == "probe" and variant_count > 1:
+            probes = variants.probe_variants(m3u8_url, candidates)
+            selection = variants.select_probed_variant(
+                probes, deadline=deadline, bandwidth_budget=bandwidth_budget
+            )
+            if selection is None:
+                logger.warning("failed to probe any variant stream; selecting the best")
+            else:
+                probe, reason = selection
+                logger.warning(f"selected variant {probe.variant.uri}: {reason}")
+                candidates.remove(probe.variant)
+                candidates.insert(0, probe.variant)
+        selected_variant = candidates[0]
         if variant_count == 1:
             logger.info(f"found 1 variant stream in {m3u8_file}")
         else:
@@ -320,9 +439,36 @@ def download_m3u8_file_and_resolve_variants(
                 f"found {variant_count} variant streams in {m3u8_file}; "
                 f"selected variant {selected_variant_spec}"
             )
+        variant_file = m3u8_file.with_suffix(variant_suffix + m3u8_file.suffix)
+        if prefetch_variants > 1 and variant_count > 1 and not variant_file.exists():
+            prefetched = _prefetch_variants(
+                m3u8_url, candidates[:prefetch_variants], variant_file
+            )
+            if prefetched is None:
+                logger.error(f"failed to download any variant of {m3u8_url}")
+                return m3u8_url, None, None
+            selected_variant = prefetched
+        if selected_variant is not variants.select_variant(m3u8_obj):
+            # Pin the selection, so that a resumed job doesn't pick a
+            # different variant from the original master playlist.
+            Playlist(variants=[selected_variant]).dump(m3u8_file)
+
+        master_url = m3u8_url
         m3u8_url = urllib.parse.urljoin(m3u8_url, selected_variant.uri)
         logger.info(f"resolved to {m3u8_url}")
-        m3u8_file = m3u8_file.with_suffix(variant_suffix + m3u8_file.suffix)
+        m3u8_file = variant_file
+
+        if use_cache and fetched is not None and fetched.modified:
+            try:
+                persistence.save_variant_selection(
+                    master_url,
+                    m3u8_url,
+                    variants.variant_score(selected_variant),
+                    etag=fetched.etag,
+                    last_modified=fetched.last_modified,
+                )
+            except peewee.PeeweeException:
+                logger.exc_warning("exception when updating cache")
 
 
 def process_entry(
@@ -337,6 +483,14 @@ def process_entry(
     keep: bool = False,
     jobs: int = None,
     concat_method: str = "concat_demuxer",
+    output_mode: str = "faststart",
+    stream_merge: bool = False,
+    merge_backend: str = "ffmpeg",
+    prefetch_variants: int = 1,
+    variant_policy: str = "best",
+    deadline: float = None,
+    bandwidth_budget: float = None,
+    live_recording: bool = False,
     retries: int = 0,
     progress: bool = True,
     event_hooks: Sequence[EventHook] = None,
@@ -377,8 +531,10 @@ def process_entry(
             logger.critical(f'failed to backup "{output}"')
             return 1
 
+    # Non-faststart outputs are written in a single sequential pass, so
+    # there's no point in landing them in the workroot first.
     merge_dest = output
-    if workroot:
+    if workroot and output_mode == "faststart":
         merge_dest = map_path(output, workroot)
 
     if merge_dest.exists() and not force:
@@ -412,28 +568,68 @@ def process_entry(
         return 1
     remote_m3u8_file = working_directory / "remote.m3u8"
     local_m3u8_file = working_directory / "local.m3u8"
+    # The playlist is downloaded, resolved and parsed only once; the
+    # parsed playlist is reused for all attempts.
+    (
+        remote_m3u8_url,
+        resolved_m3u8_file,
+        remote_m3u8_obj,
+    ) = download_m3u8_file_and_resolve_variants(
+        remote_m3u8_url,
+        remote_m3u8_file,
+        prefetch_variants=prefetch_variants,
+        variant_policy=variant_policy,
+        deadline=deadline,
+        bandwidth_budget=bandwidth_budget,
+    )
+    if resolved_m3u8_file is None or remote_m3u8_obj is None:
+        # Return without retries because we already retried a couple of
+        # times in download_m3u8_file.
+        logger.critical(f"failed to download and resolve {remote_m3u8_url}")
+        return 1
+    remote_m3u8_file = resolved_m3u8_file
+    logger.info(f"downloaded {remote_m3u8_file}")
+    if live_recording:
+        recorder = live.LiveRecorder(
+            remote_m3u8_url,
+            remote_m3u8_file,
+            local_m3u8_file,
+            jobs=jobs,
+            event_hooks=event_hooks,
+        )
+        if not recorder.record(remote_m3u8_obj):
+            logger.critical(f"failed to record {remote_m3u8_url}")
+            return 1
+        local_m3u8_obj = load_playlist(local_m3u8_file)
+    else:
+        if not remote_m3u8_obj.endlist and remote_m3u8_obj.playlist_type != "VOD":
+            logger.warning(
+                f"{remote_m3u8_url} looks like a live stream; only segments "
+                f"currently in the playlist will be downloaded "
+                f"(use --live to record the stream until it ends)"
+            )
+        local_m3u8_obj = download.local_playlist(remote_m3u8_obj)
     for ntry in range(max(retries, 0) + 1):
         try:
-            remote_m3u8_url, remote_m3u8_file = download_m3u8_file_and_resolve_variants(
-                remote_m3u8_url, remote_m3u8_file
-            )
-            if not remote_m3u8_file:
-                # Return without retries because we already retried a
-                # couple of times in download_m3u8_file.
-                logger.critical(f"failed to download and resolve {remote_m3u8_url}")
-                return 1
-            logger.info(f"downloaded {remote_m3u8_file}")
-            if not download.download_m3u8_segments(
+            if not live_recording and not download.download_m3u8_segments(
                 remote_m3u8_url,
                 remote_m3u8_file,
                 local_m3u8_file,
                 jobs=jobs,
                 progress=progress,
                 event_hooks=event_hooks,
+                remote_m3u8_obj=remote_m3u8_obj,
             ):
                 raise RuntimeError("failed to download some segments")
             merge.incremental_merge(
-                local_m3u8_file, merge_dest, concat_method=concat_method
+                local_m3u8_file,
+                merge_dest,
+                concat_method=concat_method,
+                output_mode=output_mode,
+                streaming=stream_merge,
+                backend=merge_backend,
+                event_hooks=event_hooks,
+                m3u8_obj=local_m3u8_obj,
             )
             if output != merge_dest:
                 try:
@@ -546,6 +742,19 @@ def process_batch(
     return retval
 
 
+# argparse type for bitrates like 800000, 800k, 2.5M.
+def parse_bitrate(s: str) -> float:
+    multipliers = {"k": 1e3, "m": 1e6, "g": 1e9}
+    multiplier = multipliers.get(s[-1:].lower())
+    try:
+        value = float(s[:-1] if multiplier else s) * (multiplier or 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid bitrate: '{s}'")
+    if value <= 0:
+        raise argparse.ArgumentTypeError(f"bitrate must be positive: '{s}'")
+    return value
+
+
 def main() -> int:
     user_config_options = [] if USER_CONFIG_DISABLED else load_user_config()
 
@@ -602,6 +811,75 @@ def main() -> int:
         https://github.com/zmwangx/caterpillar/#notes-and-limitations
         for details""",
     )
+    add(
+        "--output-mode",
+        choices=["faststart", "fragmented", "plain"],
+        default="faststart",
+        help="""layout of MP4/MOV output (default is 'faststart'); faststart
+        moves the index to the beginning of the file, which requires
+        writing the file twice; fragmented (fragmented MP4) and plain
+        (index at the end) are written in a single sequential pass, and
+        are written directly to the destination even when --workroot is
+        in effect""",
+    )
+    add(
+        "--stream-merge",
+        action="store_true",
+        help="""pipe merged parts directly into the final concatenation
+        instead of writing intermediate files to disk (uses named pipes
+        with the concat demuxer, which are unavailable on Windows)""",
+    )
+    add(
+        "--merge-backend",
+        choices=["ffmpeg", "pyav"],
+        default="ffmpeg",
+        help="""backend for remuxing segments into intermediate files
+        (default is 'ffmpeg'); 'pyav' remuxes in-process and detects
+        timestamp discontinuities at the packet level, and requires
+        PyAV (pip install 'caterpillar-hls[pyav]')""",
+    )
+    add(
+        "--prefetch-variants",
+        type=int,
+        default=1,
+        metavar="N",
+        help="""when the playlist has variant streams, download the
+        playlists of the top N variants concurrently, and fall back to
+        the next best variant if the best one is unavailable (default
+        is 1)""",
+    )
+    add(
+        "--variant-policy",
+        choices=["best", "probe"],
+        default="best",
+        help="""how to select among variant streams (default is 'best');
+        best selects the highest resolution and bandwidth; probe
+        downloads a couple of segments of each variant to measure
+        throughput, and selects the best variant that fits --deadline
+        and --bandwidth-budget""",
+    )
+    add(
+        "--deadline",
+        type=float,
+        metavar="SECONDS",
+        help="""with --variant-policy probe, the time within which the
+        download should complete""",
+    )
+    add(
+        "--bandwidth-budget",
+        type=parse_bitrate,
+        metavar="BITRATE",
+        help="""with --variant-policy probe, the maximum bitrate of the
+        selected variant, in bits per second (suffixes k, M, G are
+        recognized, e.g. 2.5M)""",
+    )
+    add(
+        "--live",
+        action="store_true",
+        help="""record a live (or event) stream as it is being
+        published, until the stream ends or caterpillar receives SIGINT
+        (Ctrl-C) or SIGTERM, then merge the recording""",
+    )
     add(
         "-r",
         "--retries",
@@ -704,11 +982,37 @@ def main() -> int:
         logger.critical("jobs must be positive")
         return 1
 
+    if args.prefetch_variants <= 0:
+        logger.critical("prefetch-variants must be positive")
+        return 1
+
+    if args.variant_policy == "probe":
+        if args.deadline is None and args.bandwidth_budget is None:
+            logger.critical(
+                "--variant-policy probe requires --deadline and/or --bandwidth-budget"
+            )
+            return 1
+    elif args.deadline is not None or args.bandwidth_budget is not None:
+        logger.warning(
+            "--deadline and --bandwidth-budget have no effect without "
+            "--variant-policy probe"
+        )
+
     if args.concat_method == "0":
         args.concat_method = "concat_demuxer"
     elif args.concat_method == "1":
         args.concat_method = "concat_protocol"
 
+    if args.merge_backend == "pyav":
+        if args.stream_merge:
+            logger.critical("--stream-merge is not supported by the pyav backend")
+            return 1
+        if not pyav.is_available():
+            logger.critical(
+                "PyAV not found; install it with pip install 'caterpillar-hls[pyav]'"
+            )
+            return 1
+
     if args.progress:
         progress = True
     elif args.no_progress:
@@ -725,6 +1029,14 @@ def main() -> int:
         keep=args.keep,
         jobs=args.jobs,
         concat_method=args.concat_method,
+        output_mode=args.output_mode,
+        stream_merge=args.stream_merge,
+        merge_backend=args.merge_backend,
+        prefetch_variants=args.prefetch_variants,
+        variant_policy=args.variant_policy,
+        deadline=args.deadline,
+        bandwidth_budget=args.bandwidth_budget,
+        live_recording=args.live,
         retries=args.retries,
         progress=progress,
     )
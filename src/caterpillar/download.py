@@ -8,7 +8,6 @@ import urllib.parse
 from typing import Optional, Sequence, Tuple
 
 import click
-import m3u8
 import requests
 
 from .events import (
@@ -19,8 +18,8 @@ from .events import (
     SegmentDownloadFailedEvent,
     emit_event,
 )
+from .playlist import Playlist, Segment, load_playlist
 from .utils import (
-    generate_m3u8,
     logger,
     monkeypatch_get_terminal_size,
     stub_context_manager,
@@ -50,16 +49,38 @@ def get_mtime(r: requests.Response) -> Optional[int]:
         return None
 
 
+def _set_server_timestamp(r: requests.Response, file: pathlib.Path) -> None:
+    mtime = get_mtime(r)
+    if mtime is not None:
+        atime = time.time()
+        try:
+            logger.debug(f"setting mtime on {file} to {mtime}")
+            os.utime(file, times=(atime, mtime))
+        except OSError:
+            logger.warning(f"GET {r.url}: failed to set mtime on {file}")
+
+
 # Returns a bool indicating success (True) or failure (False).
 #
 # If server_timestamp is True, set mtime of the downloaded file
 # according to timestamp reported by server.
+#
+# If byterange, a (length, offset) tuple, is specified, only that
+# sub-range of the resource is downloaded.
 def resumable_download(
-    url: str, file: pathlib.Path, server_timestamp: bool = False
+    url: str,
+    file: pathlib.Path,
+    server_timestamp: bool = False,
+    byterange: Tuple[int, int] = None,
 ) -> bool:
     headers = dict()
     existing_bytes = file.stat().st_size if file.is_file() else 0
-    if existing_bytes:
+    if byterange is not None:
+        length, offset = byterange
+        if existing_bytes >= length:
+            return True
+        headers["Range"] = f"bytes={offset + existing_bytes}-{offset + length - 1}"
+    elif existing_bytes:
         headers["Range"] = f"bytes={existing_bytes}-"
     try:
         logger.debug(f"GET {url}")
@@ -67,19 +88,15 @@ def resumable_download(
         if r.status_code not in {200, 206}:
             logger.error(f"GET {url}: HTTP {r.status_code}")
             return False
+        if byterange is not None and r.status_code != 206:
+            logger.error(f"GET {url}: server ignored byte range request")
+            return False
         with open(file, "ab") as fp:
             for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
                 if chunk:
                     fp.write(chunk)
         if server_timestamp:
-            mtime = get_mtime(r)
-            if mtime is not None:
-                atime = time.time()
-                try:
-                    logger.debug(f"setting mtime on {file} to {mtime}")
-                    os.utime(file, times=(atime, mtime))
-                except OSError:
-                    logger.warning(f"GET {url}: failed to set mtime on {file}")
+            _set_server_timestamp(r, file)
         return True
     except Exception:
         logger.exc_warning(f"GET {url}")
@@ -91,7 +108,11 @@ def resumable_download(
 # If server_timestamp is True, set mtime of the downloaded file
 # according to timestamp reported by server.
 def resumable_download_with_retries(
-    url: str, file: pathlib.Path, max_retries: int = 2, server_timestamp: bool = False
+    url: str,
+    file: pathlib.Path,
+    max_retries: int = 2,
+    server_timestamp: bool = False,
+    byterange: Tuple[int, int] = None,
 ) -> bool:
     incomplete_file = file.with_suffix(file.suffix + ".incomplete")
 
@@ -102,7 +123,9 @@ def resumable_download_with_retries(
 
     retries = 0
     while True:
-        if resumable_download(url, incomplete_file, server_timestamp=server_timestamp):
+        if resumable_download(
+            url, incomplete_file, server_timestamp=server_timestamp, byterange=byterange
+        ):
             os.replace(incomplete_file, file)
             return True
 
@@ -122,33 +145,110 @@ def download_m3u8_file(m3u8_url: str, file: pathlib.Path) -> bool:
     return resumable_download_with_retries(m3u8_url, file, server_timestamp=True)
 
 
+class PlaylistFetchResult(object):
+    def __init__(
+        self, *, modified: bool, etag: Optional[str], last_modified: Optional[str]
+    ):
+        self.modified = modified  # False if the server responded 304
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+# Download the playlist at m3u8_url to file, with retries, keeping the
+# response's validators (ETag and Last-Modified headers). If etag and/or
+# last_modified are specified, the request is conditional, and file is
+# left untouched if the server reports that the playlist is not
+# modified. Playlists are small, so unlike download_m3u8_file, this
+# doesn't bother resuming partial downloads.
+#
+# Returns None on failure.
+def fetch_m3u8_file(
+    m3u8_url: str,
+    file: pathlib.Path,
+    *,
+    etag: str = None,
+    last_modified: str = None,
+    max_retries: int = 2,
+) -> Optional[PlaylistFetchResult]:
+    headers = dict()
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    retries = 0
+    while True:
+        try:
+            logger.debug(f"GET {m3u8_url}")
+            r = requests.get(m3u8_url, headers=headers, timeout=REQUESTS_TIMEOUT)
+            if r.status_code == 304 and headers:
+                logger.info(f"{m3u8_url} not modified")
+                return PlaylistFetchResult(
+                    modified=False,
+                    etag=r.headers.get("ETag", etag),
+                    last_modified=r.headers.get("Last-Modified", last_modified),
+                )
+            if r.status_code == 200:
+                incomplete_file = file.with_suffix(file.suffix + ".incomplete")
+                with open(incomplete_file, "wb") as fp:
+                    fp.write(r.content)
+                _set_server_timestamp(r, incomplete_file)
+                os.replace(incomplete_file, file)
+                logger.info(f"downloaded {m3u8_url} to {file}")
+                return PlaylistFetchResult(
+                    modified=True,
+                    etag=r.headers.get("ETag"),
+                    last_modified=r.headers.get("Last-Modified"),
+                )
+            logger.error(f"GET {m3u8_url}: HTTP {r.status_code}")
+        except Exception:
+            logger.exc_warning(f"GET {m3u8_url}")
+
+        if retries >= max_retries:
+            logger.error(f"GET {m3u8_url}: failed after {max_retries} retries")
+            return None
+
+        retries += 1
+        wait_time = min(2 ** retries, MAX_RETRY_INTERVAL)
+        logger.warning(f"GET {m3u8_url}: retrying after {wait_time} seconds...")
+        time.sleep(wait_time)
+
+
 # Returns the path to the downloaded segment on success, otherwise None.
+#
+# byterange is the (length, offset) of the segment within url, if any.
 def download_segment(
-    url: str, index: int, directory: pathlib.Path, max_retries: int = 2
+    url: str,
+    index: int,
+    directory: pathlib.Path,
+    max_retries: int = 2,
+    byterange: Tuple[int, int] = None,
 ) -> Optional[pathlib.Path]:
     file = directory / f"{index}.ts"
-    if resumable_download_with_retries(url, file, max_retries=max_retries):
+    if resumable_download_with_retries(
+        url, file, max_retries=max_retries, byterange=byterange
+    ):
         return file
     else:
         return None
 
 
 # download_segment wrapper that takes all arguments as a single tuple
-# (with one additional argument: the logging level, so that it can be
-# set correctly for worker processes -- there's no fork on Windows, so
-# the worker processes do not actually inherit logger level), so that we
+# (url, index, directory, logging_level, byterange) -- note the
+# additional argument: the logging level, so that it can be set
+# correctly for worker processes (there's no fork on Windows, so the
+# worker processes do not actually inherit logger level) -- so that we
 # can use it with multiprocessing.pool.Pool.map and company. It also
 # gracefully consumes KeyboardInterrupt.
 #
 # Returns (url, index, downloaded_path), where downloaded_path is None
 # if download failed.
 def _download_segment_mappable(
-    args: Tuple[str, int, pathlib.Path, int]
+    args: Tuple[str, int, pathlib.Path, int, Optional[Tuple[int, int]]]
 ) -> Tuple[str, int, Optional[pathlib.Path]]:
-    url, index, directory, logging_level = args
+    url, index, directory, logging_level, byterange = args
     try:
         logger.setLevel(logging_level)
-        return url, index, download_segment(url, index, directory)
+        return url, index, download_segment(url, index, directory, byterange=byterange)
     except KeyboardInterrupt:
         logger.debug(f"download of {url} has been interrupted")
         return url, index, None
@@ -160,20 +260,31 @@ def _raise_keyboard_interrupt(signum, _):
     raise KeyboardInterrupt
 
 
-# Download all segments in remote_m3u8_file (downloaded from
-# remote_m3u8_url), and generates a local playlist in local_m3u8_file
-# with local segment filenames (0.ts, 1.ts, 2.ts, etc.).
+# The local counterpart of remote_m3u8_obj, with local segment filenames
+# (0.ts, 1.ts, 2.ts, etc.).
+def local_playlist(remote_m3u8_obj: Playlist) -> Playlist:
+    return Playlist(
+        target_duration=remote_m3u8_obj.target_duration,
+        segments=[
+            Segment(f"{index}.ts", segment.duration, None, segment.discontinuity)
+            for index, segment in enumerate(remote_m3u8_obj.segments)
+        ],
+    )
+
+
+# Download segments (of the playlist at remote_m3u8_url) to directory,
+# as <index>.ts with indices counting from start_index.
 #
 # jobs indicates the maximum number of parallel downloads. Default is
 # twice os.cpu_count().
 #
-# Returns a bool indicating success (True) or failure (False). Note that
-# an empty playlist (invalid) automatically results in a failure.
-def download_m3u8_segments(
+# Returns a bool indicating whether all segments were downloaded.
+def download_segments(
     remote_m3u8_url: str,
-    remote_m3u8_file: pathlib.Path,
-    local_m3u8_file: pathlib.Path,
+    segments: Sequence[Segment],
+    directory: pathlib.Path,
     *,
+    start_index: int = 0,
     jobs: int = None,
     progress: bool = None,
     event_hooks: Sequence[EventHook] = None,
@@ -184,30 +295,14 @@ def download_m3u8_segments(
     if event_hooks is None:
         event_hooks = []
 
-    try:
-        remote_m3u8_obj = m3u8.load(str(remote_m3u8_file))
-    except Exception:
-        logger.exc_error(f"failed to parse {remote_m3u8_file}")
-        return False
-
-    target_duration = remote_m3u8_obj.target_duration
-    local_segments = []
     download_args = []
     logging_level = logger.getEffectiveLevel()
-    for index, segment in enumerate(remote_m3u8_obj.segments):
+    for index, segment in enumerate(segments, start_index):
         url = urllib.parse.urljoin(remote_m3u8_url, segment.uri)
-        download_args.append((url, index, local_m3u8_file.parent, logging_level))
-        local_segments.append((f"{index}.ts", segment.duration))
-
-    with open(local_m3u8_file, "w", encoding="utf-8") as fp:
-        fp.write(generate_m3u8(target_duration, local_segments))
-    logger.info(f"generated {local_m3u8_file}")
+        download_args.append((url, index, directory, logging_level, segment.byterange))
 
     total = len(download_args)
-    if total == 0:
-        logger.error(f"{remote_m3u8_file}: empty playlist")
-        return False
-    jobs = min(jobs, total)
+    jobs = max(min(jobs, total), 1)
     with multiprocessing.Pool(jobs) as pool:
         emit_event(SegmentsDownloadInitiatedEvent(segment_count=total), event_hooks)
         # For the duration of the worker pool, map SIGTERM to SIGINT on
@@ -268,3 +363,48 @@ def download_m3u8_segments(
             raise
         finally:
             signal.signal(signal.SIGTERM, old_sigterm_handler)
+
+
+# Download all segments in remote_m3u8_file (downloaded from
+# remote_m3u8_url), and generates a local playlist in local_m3u8_file
+# with local segment filenames (0.ts, 1.ts, 2.ts, etc.).
+#
+# remote_m3u8_obj, if specified, is the already parsed content of
+# remote_m3u8_file.
+#
+# jobs indicates the maximum number of parallel downloads. Default is
+# twice os.cpu_count().
+#
+# Returns a bool indicating success (True) or failure (False). Note that
+# an empty playlist (invalid) automatically results in a failure.
+def download_m3u8_segments(
+    remote_m3u8_url: str,
+    remote_m3u8_file: pathlib.Path,
+    local_m3u8_file: pathlib.Path,
+    *,
+    jobs: int = None,
+    progress: bool = None,
+    event_hooks: Sequence[EventHook] = None,
+    remote_m3u8_obj: Playlist = None,
+) -> bool:
+    if remote_m3u8_obj is None:
+        try:
+            remote_m3u8_obj = load_playlist(remote_m3u8_file)
+        except Exception:
+            logger.exc_error(f"failed to parse {remote_m3u8_file}")
+            return False
+
+    local_playlist(remote_m3u8_obj).dump(local_m3u8_file)
+    logger.info(f"generated {local_m3u8_file}")
+
+    if not remote_m3u8_obj.segments:
+        logger.error(f"{remote_m3u8_file}: empty playlist")
+        return False
+    return download_segments(
+        remote_m3u8_url,
+        remote_m3u8_obj.segments,
+        local_m3u8_file.parent,
+        jobs=jobs,
+        progress=progress,
+        event_hooks=event_hooks,
+    )
@@ -1,7 +1,7 @@
 import enum
 import pathlib
 
-from typing import Callable, Sequence
+from typing import Callable, Optional, Sequence
 
 
 class EventType(enum.Enum):
@@ -9,6 +9,7 @@ class EventType(enum.Enum):
     SEGMENTS_DOWNLOAD_FINISHED = 0x12
     SEGMENT_DOWNLOAD_SUCCEEDED = 0x21
     SEGMENT_DOWNLOAD_FAILED = 0x22
+    MERGE_PROGRESS = 0x41
     MERGE_FINISHED = 0x42
 
 
@@ -57,6 +58,35 @@ class SegmentDownloadFailedEvent(Event):
         self.segment_url = segment_url
 
 
+# Progress report of an FFmpeg merge pass, parsed from FFmpeg's -progress
+# output. stage is 'partition' for passes remuxing (part of) the playlist
+# into an intermediate file (partition is then the 1-based index of the
+# intermediate file), or 'concat' for the final concatenation. The last
+# report of each pass has finished set to True.
+#
+# Note that this event is emitted from a helper thread.
+class MergeProgressEvent(Event):
+    def __init__(
+        self,
+        *,
+        stage: str,
+        partition: Optional[int],
+        out_time: Optional[float],
+        total_size: Optional[int],
+        speed: Optional[float],
+        elapsed: float,
+        finished: bool,
+    ):
+        super().__init__(EventType.MERGE_PROGRESS)
+        self.stage = stage
+        self.partition = partition
+        self.out_time = out_time
+        self.total_size = total_size
+        self.speed = speed
+        self.elapsed = elapsed
+        self.finished = finished
+
+
 class MergeFinishedEvent(Event):
     def __init__(self, *, path: pathlib.Path):
         super().__init__(EventType.MERGE_FINISHED)
@@ -0,0 +1,165 @@
+import subprocess
+import threading
+import time
+from typing import IO, Any, Callable, Dict, List, Optional
+
+from .utils import FFmpegLogLevel
+
+
+class Progress(object):
+    def __init__(
+        self,
+        *,
+        out_time: Optional[float],
+        total_size: Optional[int],
+        speed: Optional[float],
+        elapsed: float,
+        finished: bool,
+    ):
+        self.out_time = out_time  # Seconds of media written
+        self.total_size = total_size  # Bytes written
+        self.speed = speed  # Multiple of realtime
+        self.elapsed = elapsed  # Seconds since the process started
+        self.finished = finished
+
+
+ProgressCallback = Callable[[Progress], None]
+
+
+def _parse_int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _parse_speed(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value.rstrip("x")) if value is not None else None
+    except ValueError:
+        return None
+
+
+# Parses a block of key=value pairs reported by FFmpeg -progress (up to
+# but excluding the terminating progress=continue/end line).
+def parse_progress_report(
+    values: Dict[str, str], *, elapsed: float, finished: bool
+) -> Progress:
+    out_time_us = _parse_int(values.get("out_time_us"))
+    return Progress(
+        out_time=out_time_us / 1e6 if out_time_us is not None else None,
+        total_size=_parse_int(values.get("total_size")),
+        speed=_parse_speed(values.get("speed")),
+        elapsed=elapsed,
+        finished=finished,
+    )
+
+
+# A running FFmpeg process, with a machine-readable progress channel
+# (-progress) on its stdout, parsed by a helper thread. If stdout is
+# claimed by the caller (e.g. FFmpeg writes its output to stdout), the
+# progress channel is unavailable.
+#
+# progress_callback, if specified, is called (from the helper thread) on
+# every progress report, including the final one.
+class FFmpegProcess(object):
+    def __init__(
+        self,
+        command: List[str],
+        *,
+        progress_callback: ProgressCallback = None,
+        **popen_kwargs: Any,
+    ):
+        self.command = command
+        self.progress_callback = progress_callback
+        self.last_progress: Optional[Progress] = None
+        self._started_at = time.monotonic()
+        self._progress_thread = None
+        if "stdout" not in popen_kwargs:
+            command = [command[0], "-progress", "pipe:1", "-nostats", *command[1:]]
+            popen_kwargs["stdout"] = subprocess.PIPE
+            self.popen = subprocess.Popen(command, **popen_kwargs)
+            self._progress_thread = threading.Thread(
+                target=self._read_progress, args=(self.popen.stdout,), daemon=True
+            )
+            self._progress_thread.start()
+        else:
+            self.popen = subprocess.Popen(command, **popen_kwargs)
+
+    @property
+    def stdin(self) -> Optional[IO]:
+        return self.popen.stdin
+
+    @property
+    def stderr(self) -> Optional[IO]:
+        return self.popen.stderr
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self.popen.returncode
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self._started_at
+
+    def poll(self) -> Optional[int]:
+        return self.popen.poll()
+
+    def wait(self, timeout: float = None) -> int:
+        returncode = self.popen.wait(timeout)
+        if self._progress_thread is not None:
+            self._progress_thread.join()
+        return returncode
+
+    def terminate(self) -> None:
+        self.popen.terminate()
+
+    def _read_progress(self, stream: IO[bytes]) -> None:
+        values: Dict[str, str] = {}
+        for raw_line in stream:
+            key, _, value = raw_line.decode("utf-8", "replace").strip().partition("=")
+            if key != "progress":
+                values[key] = value
+                continue
+            progress = parse_progress_report(
+                values, elapsed=self.elapsed, finished=value == "end"
+            )
+            self.last_progress = progress
+            if self.progress_callback is not None:
+                self.progress_callback(progress)
+            values = {}
+        stream.close()
+
+    # Human readable summary of the throughput of a finished process.
+    def throughput_summary(self) -> Optional[str]:
+        progress = self.last_progress
+        if progress is None or not progress.total_size:
+            return None
+        mib = progress.total_size / 2 ** 20
+        summary = f"{mib:.1f} MiB in {progress.elapsed:.1f}s"
+        if progress.elapsed > 0:
+            summary += f" ({mib / progress.elapsed:.1f} MiB/s"
+            if progress.speed is not None:
+                summary += f", {progress.speed:g}x realtime"
+            summary += ")"
+        return summary
+
+
+_LOGLEVEL_TAGS = {f"[{level.name}]".encode(): level for level in FFmpegLogLevel}
+
+
+# Extracts loglevel of a raw log entry in ffmpeg output. This is a
+# cheaper equivalent of utils.ffmpeg_log_entry_get_loglevel for bytes.
+#
+# ffmpeg must be invoked with -loglevel level+<level>.
+def log_entry_get_loglevel(line: bytes) -> Optional[FFmpegLogLevel]:
+    if not line.startswith(b"["):
+        return None
+    end = line.find(b"]") + 1
+    level = _LOGLEVEL_TAGS.get(line[:end])
+    if level is None and line.startswith(b" [", end):
+        # Skip component, e.g. [libx264 @ 0x7fc93081d600]
+        start = end + 1
+        end = line.find(b"]", start) + 1
+        level = _LOGLEVEL_TAGS.get(line[start:end])
+    return level
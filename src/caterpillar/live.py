@@ -0,0 +1,283 @@
+# Recording of live (and event) playlists.
+#
+# The media playlist is polled with conditional requests (an unchanged
+# playlist only costs a 304 response), every target duration, or half
+# that if the playlist didn't change since the last poll (RFC 8216,
+# section 6.3.4). Segments are identified by their media sequence
+# numbers, so only new segments are downloaded, as soon as they appear,
+# and appended to the local playlist. Only a few counters are kept in
+# memory, so memory usage does not grow with the length of the
+# recording.
+#
+# Recording stops at #EXT-X-ENDLIST, or when SIGINT or SIGTERM is
+# received; either way, the local playlist is then finalized with
+# #EXT-X-ENDLIST, ready to be merged as usual. Recording state is saved
+# to live.json in the working directory after every batch of segments,
+# so an interrupted recording can be resumed.
+import json
+import os
+import pathlib
+import signal
+import threading
+from typing import Callable, List, Optional, Sequence
+
+from . import download
+from .events import EventHook
+from .playlist import Playlist, Segment, load_playlist
+from .utils import logger
+
+
+# Give up after this many consecutive failed polls.
+MAX_POLL_FAILURES = 10
+
+
+class LiveRecorder(object):
+    STATE_VERSION = 1
+
+    def __init__(
+        self,
+        remote_m3u8_url: str,
+        remote_m3u8_file: pathlib.Path,
+        local_m3u8_file: pathlib.Path,
+        *,
+        jobs: int = None,
+        event_hooks: Sequence[EventHook] = None,
+    ):
+        self.remote_m3u8_url = remote_m3u8_url
+        self.remote_m3u8_file = remote_m3u8_file
+        self.local_m3u8_file = local_m3u8_file
+        self.directory = local_m3u8_file.parent
+        self.state_file = self.directory / "live.json"
+        self.jobs = jobs
+        self.event_hooks = event_hooks
+
+        # Media sequence number of the next segment to record.
+        self.next_sequence: Optional[int] = None
+        # Index (local filename) of the next segment to record.
+        self.next_index = 0
+        # URI of the last recorded segment, to recover from media
+        # sequence resets.
+        self.last_uri: Optional[str] = None
+        self.recorded_count = 0
+        self.finished = False
+        # Validators of the last fetched remote playlist.
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+
+        self._stop = threading.Event()
+
+    # Request the recording to stop after the current batch of segments.
+    # Safe to call from a signal handler or another thread.
+    def stop(self) -> None:
+        self._stop.set()
+
+    # Record the stream, starting with remote_m3u8_obj, the already
+    # fetched remote playlist.
+    #
+    # Returns a bool indicating whether anything was recorded.
+    def record(self, remote_m3u8_obj: Playlist) -> bool:
+        target_duration = remote_m3u8_obj.target_duration
+        m3u8_obj: Optional[Playlist] = remote_m3u8_obj
+        if self._load_state():
+            logger.info(
+                f"resuming live recording after {self.recorded_count} segments"
+            )
+            # The playlist in hand may be from the interrupted session;
+            # start afresh with a new poll.
+            m3u8_obj = None
+        else:
+            self._start_local_playlist(target_duration)
+
+        restore_signal_handlers = self._install_signal_handlers()
+        try:
+            self._poll_loop(m3u8_obj, target_duration or 10)
+        finally:
+            restore_signal_handlers()
+
+        if not self.finished:
+            with open(self.local_m3u8_file, "a", encoding="utf-8") as fp:
+                fp.write("#EXT-X-ENDLIST\n")
+            self.finished = True
+            self._save_state()
+        logger.info(f"recorded {self.recorded_count} segments")
+        return self.recorded_count > 0
+
+    # Poll the remote playlist until the stream ends or the recording is
+    # stopped. If m3u8_obj, the current remote playlist, is None, poll
+    # right away.
+    def _poll_loop(self, m3u8_obj: Optional[Playlist], target_duration: int) -> None:
+        if self.finished:
+            return
+        failures = 0
+        wait = m3u8_obj is not None
+        while True:
+            changed = False
+            if m3u8_obj is not None:
+                target_duration = m3u8_obj.target_duration or target_duration
+                new_segments = self._new_segments(m3u8_obj)
+                if new_segments:
+                    changed = True
+                    self._record_segments(new_segments)
+                if m3u8_obj.endlist:
+                    logger.info("reached the end of the stream")
+                    return
+            if self._stop.is_set():
+                return
+
+            interval = target_duration if changed else target_duration / 2
+            if wait and self._stop.wait(max(interval, 1)):
+                return
+            wait = True
+
+            fetched = download.fetch_m3u8_file(
+                self.remote_m3u8_url,
+                self.remote_m3u8_file,
+                etag=self.etag,
+                last_modified=self.last_modified,
+            )
+            if fetched is None:
+                failures += 1
+                if failures >= MAX_POLL_FAILURES:
+                    logger.error(
+                        f"giving up after {failures} failed polls of "
+                        f"{self.remote_m3u8_url}"
+                    )
+                    return
+                m3u8_obj = None
+                continue
+            failures = 0
+            self.etag = fetched.etag
+            self.last_modified = fetched.last_modified
+            if not fetched.modified:
+                m3u8_obj = None
+                continue
+            try:
+                m3u8_obj = load_playlist(self.remote_m3u8_file)
+            except Exception:
+                logger.exc_warning(f"failed to parse {self.remote_m3u8_file}")
+                m3u8_obj = None
+
+    # Segments of m3u8_obj not yet recorded.
+    def _new_segments(self, m3u8_obj: Playlist) -> List[Segment]:
+        segments = m3u8_obj.segments
+        first_sequence = m3u8_obj.media_sequence
+        if self.next_sequence is None:
+            start = 0
+        elif first_sequence > self.next_sequence:
+            missed = first_sequence - self.next_sequence
+            logger.warning(
+                f"missed {missed} segments that slid out of the playlist "
+                f"before they could be downloaded"
+            )
+            start = 0
+        else:
+            start = self.next_sequence - first_sequence
+            if start > len(segments):
+                # The media sequence went backwards; the server was
+                # probably restarted. Try to pick up after the last
+                # recorded segment.
+                logger.warning("media sequence number reset")
+                uris = [segment.uri for segment in segments]
+                if self.last_uri in uris:
+                    start = len(uris) - uris[::-1].index(self.last_uri)
+                else:
+                    start = 0
+        self.next_sequence = first_sequence + len(segments)
+        return segments[start:]
+
+    def _record_segments(self, segments: List[Segment]) -> None:
+        start_index = self.next_index
+        logger.info(f"downloading {len(segments)} new segments...")
+        try:
+            download.download_segments(
+                self.remote_m3u8_url,
+                segments,
+                self.directory,
+                start_index=start_index,
+                jobs=self.jobs,
+                progress=False,
+                event_hooks=self.event_hooks,
+            )
+        except KeyboardInterrupt:
+            self.stop()
+        entries = []
+        for index, segment in enumerate(segments, start_index):
+            if (self.directory / f"{index}.ts").exists():
+                entries.append(f"#EXTINF:{segment.duration},\n{index}.ts\n")
+                self.recorded_count += 1
+            else:
+                logger.warning(f"skipping segment {segment.uri}")
+        with open(self.local_m3u8_file, "a", encoding="utf-8") as fp:
+            fp.write("".join(entries))
+        self.next_index = start_index + len(segments)
+        self.last_uri = segments[-1].uri
+        self._save_state()
+
+    def _start_local_playlist(self, target_duration: int) -> None:
+        with open(self.local_m3u8_file, "w", encoding="utf-8") as fp:
+            fp.write(
+                f"#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:{target_duration}\n"
+            )
+        logger.info(f"started {self.local_m3u8_file}")
+
+    # Returns a bool indicating whether a saved state was loaded.
+    def _load_state(self) -> bool:
+        if not self.local_m3u8_file.exists():
+            return False
+        try:
+            with open(self.state_file, encoding="utf-8") as fp:
+                state = json.load(fp)
+            if state["version"] != self.STATE_VERSION:
+                return False
+            self.next_sequence = state["next_sequence"]
+            self.next_index = state["next_index"]
+            self.last_uri = state["last_uri"]
+            self.recorded_count = state["recorded_count"]
+            self.finished = state["finished"]
+            return True
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.exc_warning(f"ignoring unreadable {self.state_file}")
+            return False
+
+    def _save_state(self) -> None:
+        state = dict(
+            version=self.STATE_VERSION,
+            next_sequence=self.next_sequence,
+            next_index=self.next_index,
+            last_uri=self.last_uri,
+            recorded_count=self.recorded_count,
+            finished=self.finished,
+        )
+        incomplete_path = self.state_file.with_suffix(".json.incomplete")
+        with open(incomplete_path, "w", encoding="utf-8") as fp:
+            json.dump(state, fp)
+        os.replace(incomplete_path, self.state_file)
+
+    # Make SIGINT and SIGTERM stop the recording gracefully. Returns a
+    # function that restores the original handlers.
+    def _install_signal_handlers(self) -> Callable[[], None]:
+        if threading.current_thread() is not threading.main_thread():
+            return lambda: None
+
+        pid = os.getpid()
+
+        def handler(signum, _):
+            if os.getpid() != pid:
+                # Inherited by a download worker.
+                return
+            logger.warning(
+                f"received signal {signum}; stopping recording "
+                f"(the recording so far will be merged)"
+            )
+            self.stop()
+
+        signums = (signal.SIGINT, signal.SIGTERM)
+        old_handlers = [signal.signal(signum, handler) for signum in signums]
+
+        def restore():
+            for signum, old_handler in zip(signums, old_handlers):
+                signal.signal(signum, old_handler)
+
+        return restore
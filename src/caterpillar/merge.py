@@ -1,25 +1,57 @@
+import hashlib
+import json
 import os
 import pathlib
 import re
-import shutil
 import subprocess
 import sys
 import time
-from typing import Optional, Tuple
-
-import m3u8
+from typing import Dict, List, Optional, Sequence, Tuple
 
+from . import ffmpeg, pyav
+from .events import EventHook, MergeProgressEvent, emit_event
+from .playlist import Playlist, load_playlist
 from .utils import (
     FFmpegLogLevel,
     abspath,
-    chdir,
     ffmpeg_loglevel,
-    ffmpeg_log_entry_get_loglevel,
-    generate_m3u8,
     logger,
 )
 
 
+SEGMENT_OPENING_PATTERN = re.compile(r"Opening '(?P<path>.*\.ts)' for reading")
+DTS_ERROR_MESSAGES = (
+    b"Non-monotonous DTS in output stream",
+    b"out of range for mov/mp4 format",
+)
+
+
+def _progress_emitter(
+    stage: str, partition: Optional[int], event_hooks: Optional[Sequence[EventHook]]
+) -> ffmpeg.ProgressCallback:
+    def callback(progress: ffmpeg.Progress) -> None:
+        emit_event(
+            MergeProgressEvent(
+                stage=stage,
+                partition=partition,
+                out_time=progress.out_time,
+                total_size=progress.total_size,
+                speed=progress.speed,
+                elapsed=progress.elapsed,
+                finished=progress.finished,
+            ),
+            event_hooks or [],
+        )
+
+    return callback
+
+
+def _log_throughput(p: ffmpeg.FFmpegProcess, what: str) -> None:
+    summary = p.throughput_summary()
+    if summary:
+        logger.info(f"{what}: {summary}")
+
+
 # If ignore_errors is True, blast through non-monotonous DTS errors
 # without looking back. We use this after on a splitted playlist deemed
 # all good, since for some mysterious reason, probably due to artifacts
@@ -34,26 +66,47 @@ from .utils import (
 # get a non-monotonous error from 12.ts, following a "missing picture in
 # access unit with size 6" error.
 #
+# If output is None, the merge is a dry run: the result is muxed as
+# fragmented MP4 (so that the same muxer errors are triggered) and
+# discarded.
+#
+# Progress is reported as MergeProgressEvent with stage 'partition' and
+# the specified partition index.
+#
+# m3u8_obj, if specified, is the already parsed content of m3u8_file.
+#
 # Returns None if the merge succeeds, or the basename of the first bad
 # segment if non-monotonous DTS is detected.
 def attempt_merge(
-    m3u8_file: pathlib.Path, output: pathlib.Path, ignore_errors: bool = False
+    m3u8_file: pathlib.Path,
+    output: Optional[pathlib.Path],
+    ignore_errors: bool = False,
+    *,
+    partition: int = None,
+    event_hooks: Sequence[EventHook] = None,
+    m3u8_obj: Playlist = None,
 ) -> Optional[str]:
-    logger.info(f"attempting to merge {m3u8_file} into {output}")
+    if output is not None:
+        logger.info(f"attempting to merge {m3u8_file} into {output}")
+        output_args = ["-y", str(output)]
+    else:
+        logger.info(f"attempting to merge {m3u8_file} (dry run)")
+        output_args = ["-f", "mp4", "-movflags", "frag_keyframe+empty_moov", "-y"]
+        output_args.append(os.devnull)
 
-    m3u8_obj = m3u8.load(str(m3u8_file))
+    if m3u8_obj is None:
+        m3u8_obj = load_playlist(m3u8_file)
     if len(m3u8_obj.segments) == 1:
         # Only one segment, cannot further subdivide, so ignore whatever
         # problems there may be.
         logger.info("only one segment in playlist; ignoring errors and warnings")
         ignore_errors = True
 
-    regular_pattern = re.compile(r"Opening '(?P<path>.*\.ts)' for reading")
-    error_pattern = re.compile(
-        r"(Non-monotonous DTS in output stream|out of range for mov/mp4 format)"
-    )
     user_loglevel = ffmpeg_loglevel()
     invocation_loglevel = ffmpeg_loglevel(minimum=FFmpegLogLevel.info)
+    # If the user asked for at least as much as we need, every line is
+    # echoed and there's no need to look at log levels.
+    echo_all = user_loglevel >= invocation_loglevel
     command = [
         "ffmpeg",
         "-hide_banner",
@@ -67,33 +120,35 @@ def attempt_merge(
         m3u8_file.as_posix(),
         "-c",
         "copy",
-        "-y",
-        str(output),
+        *output_args,
     ]
     logger.info(" ".join(command))
-    p = subprocess.Popen(
+    p = ffmpeg.FFmpegProcess(
         command,
+        progress_callback=_progress_emitter("partition", partition, event_hooks),
         stdin=subprocess.DEVNULL,
         stderr=subprocess.PIPE,
-        universal_newlines=True,
-        bufsize=1,
-        encoding="utf-8",
-        errors="backslashreplace",
     )
     assert p.stderr is not None
     last_read_segment = None
     for line in p.stderr:
-        entry_loglevel = ffmpeg_log_entry_get_loglevel(line)
-        if entry_loglevel is None or entry_loglevel <= user_loglevel:
-            sys.stderr.write(line)
+        if echo_all:
+            echo = True
+        else:
+            entry_loglevel = ffmpeg.log_entry_get_loglevel(line)
+            echo = entry_loglevel is None or entry_loglevel <= user_loglevel
+        if echo:
+            sys.stderr.write(line.decode("utf-8", "backslashreplace"))
             sys.stderr.flush()
-        m = regular_pattern.search(line)
-        if m:
-            last_read_segment = os.path.basename(m["path"])
-            continue
+        # Cheap substring tests first; only matching lines are decoded.
+        if b"Opening '" in line:
+            m = SEGMENT_OPENING_PATTERN.search(line.decode("utf-8", "backslashreplace"))
+            if m:
+                last_read_segment = os.path.basename(m["path"])
+                continue
         if ignore_errors:
             continue
-        if error_pattern.search(line):
+        if any(error in line for error in DTS_ERROR_MESSAGES):
             assert last_read_segment
             logger.warning(f"DTS jump detected in {last_read_segment}")
             if last_read_segment == m3u8_obj.segments[0].uri:
@@ -107,6 +162,9 @@ def attempt_merge(
 
             p.stderr.close()
             p.terminate()
+            if output is None:
+                p.wait()
+                return split_point
             # Deal with Windows process and file ownership idiosyncrasies.
             # On *ix this is immediate.
             while True:
@@ -130,40 +188,170 @@ def attempt_merge(
         logger.error(f"ffmpeg failed with exit status {returncode}")
         raise RuntimeError("unknown error occurred during merging")
     else:
+        _log_throughput(p, f"merged {m3u8_file}")
         return None
 
 
-# Split the source m3u8 file into two destination m3u8 files, at
-# split_point, which is the URL of a segment. split_point belongs to the
-# second file after splitting.
+# A durable record of merge progress, stored in the intermediate
+# directory alongside the partitions it describes, so that a killed merge
+# can be resumed without remuxing partitions that are already done.
 #
-# It's safe to overwrite the source file with one of the destinations.
-def split_m3u8(
-    source: pathlib.Path,
-    destinations: Tuple[pathlib.Path, pathlib.Path],
-    split_point: str,
-) -> None:
-    logger.info(f"splitting {source} at {split_point}")
-    m3u8_obj = m3u8.load(str(source))
-    target_duration = m3u8_obj.target_duration
-    part1_segments = []
-    part2_segments = []
-    reached_split_point = False
-    for segment in m3u8_obj.segments:
-        if segment.uri == split_point:
-            reached_split_point = True
-        tup = (segment.uri, segment.duration)
-        if reached_split_point:
-            part2_segments.append(tup)
-        else:
-            part1_segments.append(tup)
-    dest1, dest2 = destinations
-    with open(dest1, "w", encoding="utf-8") as fp:
-        fp.write(generate_m3u8(target_duration, part1_segments))
-    logger.info(f"wrote {dest1}")
-    with open(dest2, "w", encoding="utf-8") as fp:
-        fp.write(generate_m3u8(target_duration, part2_segments))
-    logger.info(f"wrote {dest2}")
+# Each completed partition is recorded with its 1-based index, the
+# half-open range [start, end) of segment indices (into the playlist
+# being merged) it covers, and the size of its output file. A checkpoint
+# is only valid for the exact playlist it was created for, identified by
+# a digest of the playlist file.
+class MergeCheckpoint(object):
+    VERSION = 1
+
+    def __init__(self, path: pathlib.Path, playlist_digest: str):
+        self.path = path
+        self.playlist_digest = playlist_digest
+        self.partitions: List[Dict[str, int]] = []
+
+    @property
+    def next_segment(self) -> int:
+        return self.partitions[-1]["end"] if self.partitions else 0
+
+    # Load the checkpoint at path if it exists and matches playlist_file,
+    # dropping any partition (and all partitions after it) whose output
+    # is missing or doesn't have the recorded size. Otherwise, start
+    # afresh.
+    @classmethod
+    def load(cls, path: pathlib.Path, playlist_file: pathlib.Path) -> "MergeCheckpoint":
+        with open(playlist_file, "rb") as fp:
+            digest = hashlib.sha1(fp.read()).hexdigest()
+        checkpoint = cls(path, digest)
+        try:
+            with open(path, encoding="utf-8") as fp:
+                data = json.load(fp)
+        except FileNotFoundError:
+            return checkpoint
+        except (OSError, ValueError):
+            logger.exc_warning(f"ignoring unreadable merge checkpoint {path}")
+            return checkpoint
+        if data.get("version") != cls.VERSION or data.get("playlist") != digest:
+            logger.info(f"{path} does not match {playlist_file}; starting afresh")
+            return checkpoint
+
+        expected_start = 0
+        for index, partition in enumerate(data.get("partitions", []), 1):
+            try:
+                output = path.parent / f"{index}.mp4"
+                if (
+                    partition["index"] != index
+                    or partition["start"] != expected_start
+                    or partition["end"] <= partition["start"]
+                    or output.stat().st_size != partition["size"]
+                ):
+                    break
+            except (KeyError, TypeError, OSError):
+                break
+            checkpoint.partitions.append(partition)
+            expected_start = partition["end"]
+        return checkpoint
+
+    def record(self, index: int, start: int, end: int, output: pathlib.Path) -> None:
+        assert index == len(self.partitions) + 1 and start == self.next_segment
+        self.partitions.append(
+            dict(index=index, start=start, end=end, size=output.stat().st_size)
+        )
+        self.save()
+
+    # Atomically and durably replace the checkpoint file.
+    def save(self) -> None:
+        data = dict(
+            version=self.VERSION,
+            playlist=self.playlist_digest,
+            partitions=self.partitions,
+        )
+        incomplete_path = self.path.with_suffix(self.path.suffix + ".incomplete")
+        with open(incomplete_path, "w", encoding="utf-8") as fp:
+            json.dump(data, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(incomplete_path, self.path)
+        logger.debug(f"updated {self.path}")
+
+
+# Write the segments in the range [start, end) of m3u8_obj to a new
+# playlist file, and return them as a playlist.
+def write_partial_m3u8(
+    m3u8_obj: Playlist, dest: pathlib.Path, start: int, end: int
+) -> Playlist:
+    part = m3u8_obj.slice(start, end)
+    part.dump(dest)
+    logger.info(f"wrote {dest}")
+    return part
+
+
+# Partitions are planned as half-open ranges [start, end) of segment
+# indices into a single segment table (the parsed playlist being
+# merged); the small playlist FFmpeg needs for a range is only written
+# right before FFmpeg is run on it, to directory/<index>.m3u8.
+class PartitionPlanner(object):
+    def __init__(
+        self,
+        m3u8_obj: Playlist,
+        directory: pathlib.Path,
+        event_hooks: Sequence[EventHook] = None,
+    ):
+        self.m3u8_obj = m3u8_obj
+        self.directory = directory
+        self.event_hooks = event_hooks
+        self.segment_count = len(m3u8_obj.segments)
+        self._segment_indices = {seg.uri: i for i, seg in enumerate(m3u8_obj.segments)}
+
+    def playlist_path(self, index: int) -> pathlib.Path:
+        return self.directory / f"{index}.m3u8"
+
+    def write_playlist(self, index: int, start: int, end: int) -> Playlist:
+        return write_partial_m3u8(self.m3u8_obj, self.playlist_path(index), start, end)
+
+    # Merge the segments from start onwards into output (or a dry run if
+    # output is None), stopping at the first DTS jump. Returns the end of
+    # the largest partition starting at start that can be merged cleanly.
+    #
+    # If output is not None and the merge is cut short, the partition
+    # [start, end) is remerged into output.
+    def merge_partition(
+        self, index: int, start: int, output: Optional[pathlib.Path]
+    ) -> int:
+        playlist = self.playlist_path(index)
+        part = self.write_playlist(index, start, self.segment_count)
+        split_point = attempt_merge(
+            playlist,
+            output,
+            partition=index,
+            event_hooks=self.event_hooks,
+            m3u8_obj=part,
+        )
+        if not split_point:
+            return self.segment_count
+        end = self._segment_indices[split_point]
+        logger.info(f"partition {index}: segments [{start}, {end})")
+        if output is not None:
+            part = self.write_playlist(index, start, end)
+            attempt_merge(
+                playlist,
+                output,
+                ignore_errors=True,
+                partition=index,
+                event_hooks=self.event_hooks,
+                m3u8_obj=part,
+            )
+        return end
+
+
+# -movflags passed to the final concat for each output mode. faststart
+# makes FFmpeg rewrite the entire output at the end to move the moov atom
+# to the front; fragmented (frag_keyframe+empty_moov) and plain
+# (non-faststart) outputs are written in a single sequential pass.
+OUTPUT_MODE_MOVFLAGS = {
+    "faststart": ["-movflags", "faststart"],
+    "fragmented": ["-movflags", "frag_keyframe+empty_moov"],
+    "plain": [],
+}
 
 
 # concat_method is either 'concat_demuxer'[1] or 'concat_protocol'[2].
@@ -173,87 +361,326 @@ def split_m3u8(
 # m3u8_file should not be named '1.m3u8'; in fact, avoid naming it
 # '<number>.m3u8', or it may be overwritten in the process.
 #
+# output_mode is one of the keys of OUTPUT_MODE_MOVFLAGS.
+#
+# If streaming is True, intermediate files are not written to disk; see
+# streaming_merge.
+#
+# backend is either 'ffmpeg' (partitions are remuxed by FFmpeg
+# subprocesses, and split points are located by scanning FFmpeg's log)
+# or 'pyav' (partitions are remuxed in-process; see pyav.py). The final
+# concatenation is always done with FFmpeg.
+#
+# Progress of FFmpeg passes is reported through MergeProgressEvent.
+#
+# m3u8_obj, if specified, is the already parsed content of m3u8_file;
+# the playlist is parsed at most once throughout the merge.
+#
+# Merge progress is checkpointed in intermediate/checkpoint.json (see
+# MergeCheckpoint), so if the process is killed midway, the next run
+# reuses completed intermediate files and only remuxes the rest.
+#
 # [1] https://ffmpeg.org/ffmpeg-all.html#concat-1
 # [2] https://ffmpeg.org/ffmpeg-all.html#concat-2
 def incremental_merge(
-    m3u8_file: pathlib.Path, output: pathlib.Path, concat_method: str = "concat_demuxer"
+    m3u8_file: pathlib.Path,
+    output: pathlib.Path,
+    concat_method: str = "concat_demuxer",
+    output_mode: str = "faststart",
+    streaming: bool = False,
+    backend: str = "ffmpeg",
+    event_hooks: Sequence[EventHook] = None,
+    m3u8_obj: Playlist = None,
 ):
+    if output_mode not in OUTPUT_MODE_MOVFLAGS:
+        raise NotImplementedError(f"unrecognized output mode '{output_mode}'")
+    movflags = OUTPUT_MODE_MOVFLAGS[output_mode]
+    if backend not in ("ffmpeg", "pyav"):
+        raise NotImplementedError(f"unrecognized merge backend '{backend}'")
+
+    if streaming and backend != "ffmpeg":
+        raise NotImplementedError("streaming merge requires the ffmpeg backend")
+    if streaming:
+        if concat_method == "concat_demuxer" and not hasattr(os, "mkfifo"):
+            logger.warning(
+                "streaming merge with the concat demuxer requires named pipes, "
+                "which are not available on this platform; "
+                "falling back to intermediate files"
+            )
+        else:
+            streaming_merge(
+                m3u8_file,
+                output,
+                concat_method,
+                output_mode,
+                event_hooks=event_hooks,
+                m3u8_obj=m3u8_obj,
+            )
+            return
+
     # Resolve output so that we don't write to a different relative path
     # later when we run FFmpeg from a different pwd.
     output = abspath(output)
     directory = m3u8_file.parent
-    playlist_index = 1
-    playlist = directory / f"{playlist_index}.m3u8"
-    shutil.copyfile(m3u8_file, playlist)
 
     intermediate_dir = directory / "intermediate"
     intermediate_dir.mkdir(exist_ok=True)
 
-    while True:
-        merge_dest = intermediate_dir / f"{playlist_index}.mp4"
-        split_point = attempt_merge(playlist, merge_dest)
-        if not split_point:
-            break
-        playlist_index += 1
-        next_playlist = directory / f"{playlist_index}.m3u8"
-        split_m3u8(playlist, (playlist, next_playlist), split_point)
-        attempt_merge(playlist, merge_dest, ignore_errors=True)
-        playlist = next_playlist
-
-    with chdir(intermediate_dir):
-        loglevel = ffmpeg_loglevel()
-        if concat_method == "concat_demuxer":
-            with open("concat.txt", "w", encoding="utf-8") as fp:
-                for index in range(1, playlist_index + 1):
-                    print(f"file {index}.mp4", file=fp)
-
-            command = [
-                "ffmpeg",
-                "-hide_banner",
-                "-loglevel",
-                f"level+{loglevel}",
-                "-f",
-                "concat",
-                "-i",
-                "concat.txt",
-                "-c",
-                "copy",
-                "-bsf:a",
-                "aac_adtstoasc",
-                "-movflags",
-                "faststart",
-                "-y",
-                str(output),
-            ]
-        elif concat_method == "concat_protocol":
-            ffmpeg_input = "concat:" + "|".join(
-                f"{i}.mp4" for i in range(1, playlist_index + 1)
+    if m3u8_obj is None:
+        m3u8_obj = load_playlist(m3u8_file)
+    segment_count = len(m3u8_obj.segments)
+    checkpoint = MergeCheckpoint.load(intermediate_dir / "checkpoint.json", m3u8_file)
+    start = checkpoint.next_segment
+    playlist_index = len(checkpoint.partitions) + 1
+    if checkpoint.partitions:
+        logger.info(
+            f"resuming merge: reusing {len(checkpoint.partitions)} intermediate "
+            f"files covering {start}/{segment_count} segments"
+        )
+
+    if start < segment_count and backend == "pyav":
+        pyav.remux_partitions(m3u8_obj, directory, intermediate_dir, checkpoint)
+    else:
+        planner = PartitionPlanner(m3u8_obj, directory, event_hooks)
+        while start < segment_count:
+            merge_dest = intermediate_dir / f"{playlist_index}.mp4"
+            end = planner.merge_partition(playlist_index, start, merge_dest)
+            checkpoint.record(playlist_index, start, end, merge_dest)
+            start = end
+            playlist_index += 1
+
+    partition_count = len(checkpoint.partitions)
+    if concat_method == "concat_demuxer":
+        with open(intermediate_dir / "concat.txt", "w", encoding="utf-8") as fp:
+            for index in range(1, partition_count + 1):
+                print(f"file {index}.mp4", file=fp)
+        input_args = ["-f", "concat", "-i", "concat.txt"]
+    elif concat_method == "concat_protocol":
+        ffmpeg_input = "concat:" + "|".join(
+            f"{i}.mp4" for i in range(1, partition_count + 1)
+        )
+        input_args = ["-i", ffmpeg_input]
+    else:
+        raise NotImplementedError(f"unrecognized concat method '{concat_method}'")
+
+    command = concat_command(input_args, output, movflags)
+    logger.info("merging intermediate products...")
+    logger.info(" ".join(command))
+    p = ffmpeg.FFmpegProcess(
+        command,
+        progress_callback=_progress_emitter("concat", None, event_hooks),
+        stdin=subprocess.DEVNULL,
+        cwd=intermediate_dir,
+    )
+    returncode = p.wait()
+    if returncode != 0:
+        _raise_ffmpeg_failure(returncode)
+    _log_throughput(p, "concatenated intermediate products")
+    logger.info(f"merged into {output}")
+
+
+# The FFmpeg command for the final concatenation of partitions into
+# output. input_args specifies the concatenated input.
+def concat_command(
+    input_args: List[str], output: pathlib.Path, movflags: List[str]
+) -> List[str]:
+    loglevel = ffmpeg_loglevel()
+    return [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        f"level+{loglevel}",
+        *input_args,
+        "-c",
+        "copy",
+        "-bsf:a",
+        "aac_adtstoasc",
+        *movflags,
+        "-y",
+        str(output),
+    ]
+
+
+# The FFmpeg command for remuxing the partition m3u8_file into an MPEG-TS
+# stream written to dest (a path or an FFmpeg pipe: URL).
+def partition_stream_command(m3u8_file: pathlib.Path, dest: str) -> List[str]:
+    loglevel = ffmpeg_loglevel()
+    return [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        f"level+{loglevel}",
+        "-f",
+        "hls",
+        "-i",
+        m3u8_file.as_posix(),
+        "-c",
+        "copy",
+        "-f",
+        "mpegts",
+        "-y",
+        dest,
+    ]
+
+
+def _raise_ffmpeg_failure(returncode: int) -> None:
+    logger.error(f"ffmpeg failed with exit status {returncode}")
+    raise RuntimeError("unknown error occurred during merging")
+
+
+def _terminate(p: ffmpeg.FFmpegProcess) -> None:
+    if p.poll() is None:
+        p.terminate()
+        p.wait()
+
+
+# Streaming counterpart of the partition and concat steps of
+# incremental_merge: split points are located with dry runs, then each
+# partition is remuxed to MPEG-TS and piped straight into a single
+# concat FFmpeg process, so that no intermediate media file is written
+# to disk.
+#
+# With the concat demuxer, each partition is fed through a named pipe
+# (intermediate/<index>.fifo) listed in concat.txt; with the concat
+# protocol, the partitions are simply piped one after another into the
+# stdin of the concat process (MPEG-TS can be concatenated byte-wise).
+def streaming_merge(
+    m3u8_file: pathlib.Path,
+    output: pathlib.Path,
+    concat_method: str = "concat_demuxer",
+    output_mode: str = "faststart",
+    *,
+    event_hooks: Sequence[EventHook] = None,
+    m3u8_obj: Playlist = None,
+) -> None:
+    movflags = OUTPUT_MODE_MOVFLAGS[output_mode]
+    output = abspath(output)
+    directory = m3u8_file.parent
+    intermediate_dir = directory / "intermediate"
+    intermediate_dir.mkdir(exist_ok=True)
+
+    if m3u8_obj is None:
+        m3u8_obj = load_playlist(m3u8_file)
+    planner = PartitionPlanner(m3u8_obj, directory, event_hooks)
+    ranges: List[Tuple[int, int]] = []
+    start = 0
+    while start < planner.segment_count:
+        end = planner.merge_partition(len(ranges) + 1, start, None)
+        ranges.append((start, end))
+        start = end
+
+    logger.info(f"streaming {len(ranges)} partitions into {output}...")
+    if concat_method == "concat_demuxer":
+        _stream_through_fifos(
+            planner, ranges, intermediate_dir, output, movflags, event_hooks
+        )
+    elif concat_method == "concat_protocol":
+        _stream_through_stdin(planner, ranges, output, movflags, event_hooks)
+    else:
+        raise NotImplementedError(f"unrecognized concat method '{concat_method}'")
+    logger.info(f"merged into {output}")
+
+
+def _stream_through_fifos(
+    planner: PartitionPlanner,
+    ranges: List[Tuple[int, int]],
+    intermediate_dir: pathlib.Path,
+    output: pathlib.Path,
+    movflags: List[str],
+    event_hooks: Optional[Sequence[EventHook]],
+) -> None:
+    fifos = []
+    for index in range(1, len(ranges) + 1):
+        fifo = abspath(intermediate_dir / f"{index}.fifo")
+        if fifo.exists():
+            fifo.unlink()
+        os.mkfifo(fifo)  # pylint: disable=no-member
+        fifos.append(fifo)
+    with open(intermediate_dir / "concat.txt", "w", encoding="utf-8") as fp:
+        for fifo in fifos:
+            print(f"file {fifo.name}", file=fp)
+
+    command = concat_command(["-f", "concat", "-i", "concat.txt"], output, movflags)
+    logger.info(" ".join(command))
+    concat = ffmpeg.FFmpegProcess(
+        command,
+        progress_callback=_progress_emitter("concat", None, event_hooks),
+        stdin=subprocess.DEVNULL,
+        cwd=intermediate_dir,
+    )
+    try:
+        # Partitions are remuxed one at a time, in the order the concat
+        # demuxer opens the pipes.
+        for partition, ((start, end), fifo) in enumerate(zip(ranges, fifos), 1):
+            planner.write_playlist(partition, start, end)
+            writer_command = partition_stream_command(
+                planner.playlist_path(partition), str(fifo)
             )
-            command = [
-                "ffmpeg",
-                "-hide_banner",
-                "-loglevel",
-                f"level+{loglevel}",
-                "-i",
-                ffmpeg_input,
-                "-c",
-                "copy",
-                "-bsf:a",
-                "aac_adtstoasc",
-                "-movflags",
-                "faststart",
-                "-y",
-                str(output),
-            ]
-        else:
-            raise NotImplementedError(f"unrecognized concat method '{concat_method}'")
+            logger.info(" ".join(writer_command))
+            writer = ffmpeg.FFmpegProcess(
+                writer_command,
+                progress_callback=_progress_emitter(
+                    "partition", partition, event_hooks
+                ),
+                stdin=subprocess.DEVNULL,
+            )
+            while True:
+                try:
+                    returncode = writer.wait(timeout=0.5)
+                    break
+                except subprocess.TimeoutExpired:
+                    # If the reader is gone, the writer may block on the
+                    # pipe forever.
+                    concat_returncode = concat.poll()
+                    if concat_returncode is not None:
+                        _terminate(writer)
+                        _raise_ffmpeg_failure(concat_returncode)
+            if returncode != 0:
+                _raise_ffmpeg_failure(returncode)
+        returncode = concat.wait()
+        if returncode != 0:
+            _raise_ffmpeg_failure(returncode)
+        _log_throughput(concat, "streamed partitions")
+    finally:
+        _terminate(concat)
+        for fifo in fifos:
+            try:
+                fifo.unlink()
+            except OSError:
+                pass
 
-        try:
-            logger.info("merging intermediate products...")
-            logger.info(" ".join(command))
-            subprocess.run(command, stdin=subprocess.DEVNULL, check=True)
-        except subprocess.CalledProcessError as e:
-            logger.error(f"ffmpeg failed with exit status {e.returncode}")
-            raise RuntimeError("unknown error occurred during merging") from e
-        else:
-            logger.info(f"merged into {output}")
+
+def _stream_through_stdin(
+    planner: PartitionPlanner,
+    ranges: List[Tuple[int, int]],
+    output: pathlib.Path,
+    movflags: List[str],
+    event_hooks: Optional[Sequence[EventHook]],
+) -> None:
+    command = concat_command(["-f", "mpegts", "-i", "pipe:0"], output, movflags)
+    logger.info(" ".join(command))
+    concat = ffmpeg.FFmpegProcess(
+        command,
+        progress_callback=_progress_emitter("concat", None, event_hooks),
+        stdin=subprocess.PIPE,
+    )
+    try:
+        for partition, (start, end) in enumerate(ranges, 1):
+            planner.write_playlist(partition, start, end)
+            writer_command = partition_stream_command(
+                planner.playlist_path(partition), "pipe:1"
+            )
+            logger.info(" ".join(writer_command))
+            returncode = subprocess.run(
+                writer_command, stdin=subprocess.DEVNULL, stdout=concat.stdin
+            ).returncode
+            if returncode != 0:
+                _raise_ffmpeg_failure(returncode)
+        assert concat.stdin is not None
+        concat.stdin.close()
+        returncode = concat.wait()
+        if returncode != 0:
+            _raise_ffmpeg_failure(returncode)
+        _log_throughput(concat, "streamed partitions")
+    finally:
+        _terminate(concat)
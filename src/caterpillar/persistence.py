@@ -1,7 +1,8 @@
 import functools
+import json
 import pathlib
 import time
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Dict, Optional, Sequence
 
 import peewee
 
@@ -11,6 +12,7 @@ from .utils import CACHING_DISABLED, USER_DATA_DIR, abspath
 SCHEMA_VERSION = 1
 DATABASE_PATH = pathlib.Path(USER_DATA_DIR).joinpath("data.db")
 CACHE_EXPIRY_THRESHOLD = 3600 * 24 * 7  # A week
+VARIANT_SELECTION_TTL = 3600  # Revalidate cached variant selections after an hour
 
 database = peewee.SqliteDatabase(None)
 _database_initialized = False
@@ -29,6 +31,25 @@ class URL(_BaseModel):
     last_access = peewee.FloatField()  # POSIX timestamp
 
 
+# Variant selected for a master playlist, with the master playlist's
+# HTTP validators so that it can be revalidated with a conditional GET.
+class VariantSelection(_BaseModel):
+    master_url = peewee.TextField(unique=True)
+    variant_url = peewee.TextField()
+    score = peewee.TextField()  # JSON-encoded variants.variant_score
+    etag = peewee.TextField(null=True)
+    last_modified = peewee.TextField(null=True)
+    validated_at = peewee.FloatField()  # POSIX timestamp
+
+    @property
+    def fresh(self) -> bool:
+        return time.time() - self.validated_at < VARIANT_SELECTION_TTL
+
+    @property
+    def variant_score(self) -> Sequence[int]:
+        return json.loads(self.score)
+
+
 def initialize_database(path: pathlib.Path = None) -> None:
     global _database_initialized
     if _database_initialized:
@@ -48,11 +69,14 @@ def initialize_database(path: pathlib.Path = None) -> None:
         # New database
         database.execute_sql(f"PRAGMA user_version = {SCHEMA_VERSION};")
 
-    database.create_tables([URL], safe=True)
+    database.create_tables([URL, VariantSelection], safe=True)
 
     # Expire old entries
     expiry_time = time.time() - CACHE_EXPIRY_THRESHOLD
     URL.delete().where(URL.last_access < expiry_time).execute()
+    VariantSelection.delete().where(
+        VariantSelection.validated_at < expiry_time
+    ).execute()
 
     _database_initialized = True
 
@@ -137,3 +161,51 @@ def get_workdir(url: str) -> Optional[pathlib.Path]:
         return pathlib.Path(record.workdir)
     except peewee.DoesNotExist:
         return None
+
+
+@requires_cache()
+@ensure_database
+def get_variant_selection(master_url: str) -> Optional[VariantSelection]:
+    try:
+        return VariantSelection.get(VariantSelection.master_url == master_url)
+    except peewee.DoesNotExist:
+        return None
+
+
+@requires_cache()
+@ensure_database
+@database.atomic()
+def save_variant_selection(
+    master_url: str,
+    variant_url: str,
+    score: Sequence[int],
+    *,
+    etag: str = None,
+    last_modified: str = None,
+) -> None:
+    VariantSelection.replace(
+        master_url=master_url,
+        variant_url=variant_url,
+        score=json.dumps(list(score)),
+        etag=etag,
+        last_modified=last_modified,
+        validated_at=time.time(),
+    ).execute()
+
+
+# Mark a cached variant selection as freshly validated, e.g. after the
+# master playlist is found unmodified.
+@requires_cache()
+@ensure_database
+@database.atomic()
+def revalidate_variant_selection(
+    master_url: str, *, etag: str = None, last_modified: str = None
+) -> None:
+    update: Dict[str, Any] = dict(validated_at=time.time())
+    if etag is not None:
+        update["etag"] = etag
+    if last_modified is not None:
+        update["last_modified"] = last_modified
+    VariantSelection.update(**update).where(
+        VariantSelection.master_url == master_url
+    ).execute()
@@ -0,0 +1,231 @@
+# A lightweight M3U8 playlist model with a fast line-oriented parser.
+#
+# A playlist is parsed once per job and passed around (through download
+# and merge) instead of being reloaded with the m3u8 library at every
+# step, which builds heavyweight objects for every segment. Only what
+# caterpillar needs is extracted: segment URIs, durations, byte ranges
+# and discontinuity flags for media playlists, and URIs plus a few
+# attributes of EXT-X-STREAM-INF for master playlists. Other tags are
+# ignored.
+import math
+import pathlib
+import re
+from typing import Dict, List, Optional, Tuple
+
+from .utils import generate_m3u8, logger
+
+
+class Segment(object):
+    __slots__ = ("uri", "duration", "byterange", "discontinuity")
+
+    def __init__(
+        self,
+        uri: str,
+        duration: float,
+        byterange: Tuple[int, int] = None,
+        discontinuity: bool = False,
+    ):
+        self.uri = uri
+        self.duration = duration
+        # (length, offset), with the offset always resolved.
+        self.byterange = byterange
+        self.discontinuity = discontinuity
+
+    def __repr__(self):
+        return (
+            f"Segment(uri={self.uri!r}, duration={self.duration!r}, "
+            f"byterange={self.byterange!r}, discontinuity={self.discontinuity!r})"
+        )
+
+
+class Variant(object):
+    __slots__ = ("uri", "bandwidth", "average_bandwidth", "resolution", "codecs")
+
+    def __init__(
+        self,
+        uri: str,
+        *,
+        bandwidth: int = None,
+        average_bandwidth: int = None,
+        resolution: Tuple[int, int] = None,
+        codecs: str = None,
+    ):
+        self.uri = uri
+        self.bandwidth = bandwidth
+        self.average_bandwidth = average_bandwidth
+        self.resolution = resolution
+        self.codecs = codecs
+
+    def __str__(self):
+        attrs = []
+        if self.bandwidth is not None:
+            attrs.append(f"BANDWIDTH={self.bandwidth}")
+        if self.average_bandwidth is not None:
+            attrs.append(f"AVERAGE-BANDWIDTH={self.average_bandwidth}")
+        if self.resolution is not None:
+            attrs.append("RESOLUTION=%dx%d" % self.resolution)
+        if self.codecs is not None:
+            attrs.append(f'CODECS="{self.codecs}"')
+        return f"#EXT-X-STREAM-INF:{','.join(attrs)}\n{self.uri}"
+
+
+class Playlist(object):
+    __slots__ = (
+        "target_duration",
+        "media_sequence",
+        "playlist_type",
+        "endlist",
+        "segments",
+        "variants",
+    )
+
+    def __init__(
+        self,
+        *,
+        target_duration: int = 0,
+        media_sequence: int = 0,
+        playlist_type: str = None,
+        endlist: bool = False,
+        segments: List[Segment] = None,
+        variants: List[Variant] = None,
+    ):
+        self.target_duration = target_duration
+        self.media_sequence = media_sequence
+        self.playlist_type = playlist_type
+        self.endlist = endlist
+        self.segments = segments if segments is not None else []
+        self.variants = variants if variants is not None else []
+
+    @property
+    def is_variant(self) -> bool:
+        return bool(self.variants)
+
+    @property
+    def duration(self) -> float:
+        return sum(segment.duration for segment in self.segments)
+
+    # A new playlist with the segments in the range [start, end).
+    def slice(self, start: int, end: int = None) -> "Playlist":
+        return Playlist(
+            target_duration=self.target_duration,
+            media_sequence=self.media_sequence + start,
+            playlist_type=self.playlist_type,
+            endlist=self.endlist,
+            segments=self.segments[start:end],
+        )
+
+    def dumps(self) -> str:
+        if self.is_variant:
+            return "".join(
+                ["#EXTM3U\n", *(f"{variant}\n" for variant in self.variants)]
+            )
+        return generate_m3u8(
+            self.target_duration,
+            ((segment.uri, segment.duration) for segment in self.segments),
+        )
+
+    def dump(self, path: pathlib.Path) -> None:
+        with open(path, "w", encoding="utf-8") as fp:
+            fp.write(self.dumps())
+
+
+ATTRIBUTE_PATTERN = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+def _parse_attributes(s: str) -> Dict[str, str]:
+    return {key: value.strip('"') for key, value in ATTRIBUTE_PATTERN.findall(s)}
+
+
+def _parse_int(s: Optional[str]) -> Optional[int]:
+    try:
+        return int(s) if s is not None else None
+    except ValueError:
+        return None
+
+
+def _parse_variant(attrs: Dict[str, str], uri: str) -> Variant:
+    resolution = None
+    if "RESOLUTION" in attrs:
+        width, _, height = attrs["RESOLUTION"].partition("x")
+        try:
+            resolution = (int(width), int(height))
+        except ValueError:
+            pass
+    return Variant(
+        uri,
+        bandwidth=_parse_int(attrs.get("BANDWIDTH")),
+        average_bandwidth=_parse_int(attrs.get("AVERAGE-BANDWIDTH")),
+        resolution=resolution,
+        codecs=attrs.get("CODECS"),
+    )
+
+
+# Parse the text of an M3U8 playlist.
+#
+# Raises ValueError if the playlist is malformed.
+def parse_playlist(content: str) -> Playlist:
+    playlist = Playlist()
+    segments = playlist.segments
+    duration = None  # type: Optional[float]
+    byterange = None  # type: Optional[Tuple[int, Optional[int]]]
+    discontinuity = False
+    stream_inf = None  # type: Optional[Dict[str, str]]
+    # End of the previous byte range, for byte ranges without an offset.
+    next_offset = 0
+    encryption_warned = False
+    for line in content.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith("#"):
+            if stream_inf is not None:
+                playlist.variants.append(_parse_variant(stream_inf, line))
+                stream_inf = None
+                continue
+            if byterange is not None:
+                length, offset = byterange
+                if offset is None:
+                    offset = next_offset
+                next_offset = offset + length
+                resolved_byterange = (length, offset)  # type: Optional[Tuple[int, int]]
+            else:
+                resolved_byterange = None
+            segments.append(
+                Segment(line, duration or 0.0, resolved_byterange, discontinuity)
+            )
+            duration = None
+            byterange = None
+            discontinuity = False
+            continue
+
+        tag, _, value = line.partition(":")
+        try:
+            if tag == "#EXTINF":
+                duration = float(value.partition(",")[0])
+            elif tag == "#EXT-X-BYTERANGE":
+                length_str, _, offset_str = value.partition("@")
+                byterange = (int(length_str), int(offset_str) if offset_str else None)
+            elif tag == "#EXT-X-DISCONTINUITY":
+                discontinuity = True
+            elif tag == "#EXT-X-TARGETDURATION":
+                playlist.target_duration = math.ceil(float(value))
+            elif tag == "#EXT-X-MEDIA-SEQUENCE":
+                playlist.media_sequence = int(value)
+            elif tag == "#EXT-X-PLAYLIST-TYPE":
+                playlist.playlist_type = value.upper()
+            elif tag == "#EXT-X-ENDLIST":
+                playlist.endlist = True
+            elif tag == "#EXT-X-STREAM-INF":
+                stream_inf = _parse_attributes(value)
+            elif tag == "#EXT-X-KEY" and not encryption_warned:
+                if _parse_attributes(value).get("METHOD", "NONE") != "NONE":
+                    logger.warning("encrypted segments are not supported")
+                    encryption_warned = True
+        except ValueError:
+            raise ValueError(f"malformed line in playlist: {line}")
+    return playlist
+
+
+def load_playlist(path: pathlib.Path) -> Playlist:
+    with open(path, encoding="utf-8") as fp:
+        return parse_playlist(fp.read())
@@ -0,0 +1,159 @@
+# In-process merge backend built on PyAV (optional dependency).
+#
+# Instead of spawning FFmpeg and scraping its log for "Non-monotonous
+# DTS" errors, segments are demuxed in-process and their packet
+# timestamps are inspected directly; when a segment's timestamps jump
+# relative to the partition being written, a new partition is started
+# right away, without tearing down and restarting anything.
+import pathlib
+from typing import TYPE_CHECKING, Any, Dict, List
+
+from .playlist import Playlist
+from .utils import logger
+
+if TYPE_CHECKING:
+    from .merge import MergeCheckpoint  # pylint: disable=cyclic-import
+
+
+# Largest forward DTS jump (in the input time base) tolerated within a
+# partition; mov/mp4 sample durations are 32-bit, and larger jumps lead
+# to "out of range for mov/mp4 format" errors.
+MAX_DTS_JUMP = 2 ** 31 - 1
+
+
+def is_available() -> bool:
+    try:
+        import av  # noqa: F401 pylint: disable=import-outside-toplevel,unused-import
+    except ImportError:
+        return False
+    return True
+
+
+class _PartitionWriter(object):
+    def __init__(
+        self, av: Any, path: pathlib.Path, index: int, start: int, streams: List[Any]
+    ):
+        self.path = path
+        self.index = index
+        self.start = start
+        self.container = av.open(str(path), "w", format="mp4")
+        self.codec_types = [stream.type for stream in streams]
+        add_stream_from_template = getattr(
+            self.container, "add_stream_from_template", None
+        )
+        if add_stream_from_template is not None:
+            self.streams = [add_stream_from_template(stream) for stream in streams]
+        else:
+            self.streams = [
+                self.container.add_stream(template=stream) for stream in streams
+            ]
+        # Last muxed DTS of each output stream, in the input time base.
+        self.last_dts: Dict[int, int] = {}
+
+    # Returns True if muxing packets (from a segment with the specified
+    # streams) into this partition would break timestamp monotonicity,
+    # or if the stream layout is different.
+    def is_discontinuous(self, streams: List[Any], packets: List[Any]) -> bool:
+        if [stream.type for stream in streams] != self.codec_types:
+            return True
+        positions = {stream.index: pos for pos, stream in enumerate(streams)}
+        last_dts = dict(self.last_dts)
+        for packet in packets:
+            pos = positions[packet.stream.index]
+            prev = last_dts.get(pos)
+            if prev is not None and (
+                packet.dts <= prev or packet.dts - prev > MAX_DTS_JUMP
+            ):
+                return True
+            last_dts[pos] = packet.dts
+        return False
+
+    # Mux packets, nudging non-monotonous timestamps forward the same way
+    # FFmpeg does (only reachable within the first segment of a
+    # partition, which cannot be further subdivided).
+    def mux(self, streams: List[Any], packets: List[Any]) -> None:
+        positions = {stream.index: pos for pos, stream in enumerate(streams)}
+        for packet in packets:
+            pos = positions[packet.stream.index]
+            prev = self.last_dts.get(pos)
+            if prev is not None and packet.dts <= prev:
+                packet.dts = prev + 1
+                if packet.pts is not None and packet.pts < packet.dts:
+                    packet.pts = packet.dts
+            self.last_dts[pos] = packet.dts
+            packet.stream = self.streams[pos]
+            self.container.mux(packet)
+
+    def close(self) -> None:
+        self.container.close()
+        logger.info(f"wrote {self.path}")
+
+
+# Remux the segments of m3u8_obj (the playlist of local segments in
+# directory) into intermediate_dir/<index>.mp4, continuing after the
+# partitions already recorded in checkpoint, and recording each new
+# partition in checkpoint. The results are equivalent to the partitions
+# produced by the FFmpeg backend in merge.incremental_merge.
+def remux_partitions(
+    m3u8_obj: Playlist,
+    directory: pathlib.Path,
+    intermediate_dir: pathlib.Path,
+    checkpoint: "MergeCheckpoint",
+) -> None:
+    # pylint: disable=import-outside-toplevel
+    import av
+
+    segments = m3u8_obj.segments
+    writer = None
+    try:
+        for i in range(checkpoint.next_segment, len(segments)):
+            uri = segments[i].uri
+            logger.debug(f"remuxing {uri}")
+            with av.open(str(directory / uri)) as container:
+                streams = [
+                    stream
+                    for stream in container.streams
+                    if stream.type in ("video", "audio")
+                ]
+                packets = [
+                    packet
+                    for packet in container.demux(streams)
+                    if packet.dts is not None
+                ]
+                if writer is not None and writer.is_discontinuous(streams, packets):
+                    logger.warning(f"DTS jump detected in {uri}")
+                    writer.close()
+                    checkpoint.record(writer.index, writer.start, i, writer.path)
+                    writer = None
+                split_after = False
+                if writer is None:
+                    index = len(checkpoint.partitions) + 1
+                    writer = _PartitionWriter(
+                        av, intermediate_dir / f"{index}.mp4", index, i, streams
+                    )
+                    if writer.is_discontinuous(streams, packets) and i + 1 < len(
+                        segments
+                    ):
+                        logger.warning(
+                            f"DTS jump detected in {uri}, the first segment "
+                            f"of a partition; splitting at the next segment"
+                        )
+                        split_after = True
+                writer.mux(streams, packets)
+                if split_after:
+                    writer.close()
+                    checkpoint.record(writer.index, writer.start, i + 1, writer.path)
+                    writer = None
+        if writer is not None:
+            writer.close()
+            checkpoint.record(writer.index, writer.start, len(segments), writer.path)
+            writer = None
+    except Exception as e:
+        logger.exc_error("PyAV remux failed")
+        raise RuntimeError("unknown error occurred during merging") from e
+    finally:
+        if writer is not None:
+            try:
+                writer.container.close()
+            except Exception:
+                pass
@@ -1,22 +1,204 @@
-import m3u8
+import concurrent.futures
+import time
+import urllib.parse
+from typing import List, Optional, Sequence, Tuple
 
-from typing import Tuple
+import requests
+
+from .download import CHUNK_SIZE, REQUESTS_TIMEOUT
+from .playlist import Playlist, Variant, parse_playlist
+from .utils import logger
 
 
 # Rate variant stream by resolution, average bandwidth, and bandwidth.
-def variant_score(variant: m3u8.Playlist) -> Tuple[int, int, int, int]:
-    stream_info = variant.stream_info
-    if stream_info.resolution:
-        width, height = stream_info.resolution
+def variant_score(variant: Variant) -> Tuple[int, int, int, int]:
+    if variant.resolution:
+        width, height = variant.resolution
     else:
         width = height = 0
-    average_bandwidth = stream_info.average_bandwidth or 0
-    bandwidth = stream_info.bandwidth or 0
+    average_bandwidth = variant.average_bandwidth or 0
+    bandwidth = variant.bandwidth or 0
     return (width, height, average_bandwidth, bandwidth)
 
 
+# Inverse of variant_score, i.e., a variant with the specified uri and
+# the attributes that result in score.
+def variant_from_score(uri: str, score: Sequence[int]) -> Variant:
+    width, height, average_bandwidth, bandwidth = score
+    return Variant(
+        uri,
+        bandwidth=bandwidth or None,
+        average_bandwidth=average_bandwidth or None,
+        resolution=(width, height) if width and height else None,
+    )
+
+
+# Variant streams from best to worst.
+def rank_variants(m3u8_obj: Playlist) -> List[Variant]:
+    return sorted(m3u8_obj.variants, key=variant_score, reverse=True)
+
+
 # Select the best variant stream (best effort).
 #
 # Assumption: m3u8 object has one or more variants.
-def select_variant(m3u8_obj: m3u8.M3U8) -> m3u8.Playlist:
-    return sorted(m3u8_obj.playlists, key=variant_score, reverse=True)[0]
+def select_variant(m3u8_obj: Playlist) -> Variant:
+    return rank_variants(m3u8_obj)[0]
+
+
+# Result of probing a variant stream: the total media duration of the
+# variant, and a sample of its segments to measure the achievable
+# download throughput and the actual bitrate of the stream.
+class VariantProbe(object):
+    def __init__(
+        self,
+        variant: Variant,
+        *,
+        duration: float = 0.0,
+        sample_bytes: int = 0,
+        sample_duration: float = 0.0,
+        sample_elapsed: float = 0.0,
+        error: str = None,
+    ):
+        self.variant = variant
+        self.duration = duration  # Seconds of media in the variant
+        self.sample_bytes = sample_bytes
+        self.sample_duration = sample_duration  # Seconds of media sampled
+        self.sample_elapsed = sample_elapsed  # Seconds spent downloading
+        self.error = error
+
+    # Bits per second of media.
+    @property
+    def bitrate(self) -> Optional[float]:
+        if self.error or not self.sample_duration:
+            return None
+        return self.sample_bytes * 8 / self.sample_duration
+
+    # Bytes per second of download.
+    @property
+    def throughput(self) -> Optional[float]:
+        if self.error or not self.sample_elapsed:
+            return None
+        return self.sample_bytes / self.sample_elapsed
+
+    # Estimated seconds to download the entire variant.
+    @property
+    def estimated_download_time(self) -> Optional[float]:
+        bitrate = self.bitrate
+        throughput = self.throughput
+        if bitrate is None or not throughput:
+            return None
+        return self.duration * bitrate / 8 / throughput
+
+    def __str__(self):
+        if self.error:
+            return f"{self.variant.uri}: {self.error}"
+        return (
+            f"{self.variant.uri}: {(self.bitrate or 0) / 1e3:.0f} kbps, "
+            f"{(self.throughput or 0) * 8 / 1e6:.1f} Mbps download, "
+            f"~{self.estimated_download_time or 0:.0f}s for {self.duration:.0f}s"
+        )
+
+
+# Download a couple of segments (evenly spread across the stream) of the
+# variant of the master playlist at master_url, timing the downloads.
+def probe_variant(
+    master_url: str, variant: Variant, *, sample_segments: int = 2
+) -> VariantProbe:
+    url = urllib.parse.urljoin(master_url, variant.uri)
+    try:
+        r = requests.get(url, timeout=REQUESTS_TIMEOUT)
+        r.raise_for_status()
+        m3u8_obj = parse_playlist(r.text)
+        if m3u8_obj.is_variant or not m3u8_obj.segments:
+            return VariantProbe(variant, error="not a media playlist")
+        segments = m3u8_obj.segments
+        count = min(sample_segments, len(segments))
+        sample = [segments[i * len(segments) // count] for i in range(count)]
+        probe = VariantProbe(variant, duration=m3u8_obj.duration)
+        for segment in sample:
+            headers = dict()
+            if segment.byterange is not None:
+                length, offset = segment.byterange
+                headers["Range"] = f"bytes={offset}-{offset + length - 1}"
+            start_time = time.monotonic()
+            r = requests.get(
+                urllib.parse.urljoin(url, segment.uri),
+                headers=headers,
+                stream=True,
+                timeout=REQUESTS_TIMEOUT,
+            )
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                probe.sample_bytes += len(chunk)
+            probe.sample_elapsed += time.monotonic() - start_time
+            probe.sample_duration += segment.duration
+        return probe
+    except Exception as e:
+        return VariantProbe(variant, error=str(e) or type(e).__name__)
+
+
+# Probe candidates (variants of the master playlist at master_url)
+# concurrently. Results are in the same order as candidates.
+def probe_variants(
+    master_url: str, candidates: Sequence[Variant], *, sample_segments: int = 2
+) -> List[VariantProbe]:
+    logger.info(f"probing {len(candidates)} variant streams...")
+    with concurrent.futures.ThreadPoolExecutor(len(candidates)) as executor:
+        probes = list(
+            executor.map(
+                lambda v: probe_variant(master_url, v, sample_segments=sample_segments),
+                candidates,
+            )
+        )
+    for probe in probes:
+        logger.info(f"probed {probe}")
+    return probes
+
+
+# Select among probes (ranked from best to worst variant) the best
+# variant whose bitrate is within bandwidth_budget (bits per second) and
+# whose estimated download time is within deadline (seconds). If no
+# variant satisfies the constraints, the one that violates them the least
+# is selected.
+#
+# Returns the selected probe and a human readable reason for the choice,
+# or None if no variant could be probed.
+def select_probed_variant(
+    probes: Sequence[VariantProbe],
+    *,
+    deadline: float = None,
+    bandwidth_budget: float = None,
+) -> Optional[Tuple[VariantProbe, str]]:
+    # (probe, bitrate, estimated download time)
+    candidates = [
+        (p, p.bitrate or 0.0, p.estimated_download_time)
+        for p in probes
+        if p.estimated_download_time is not None
+    ]  # type: List[Tuple[VariantProbe, float, float]]
+    if not candidates:
+        return None
+    reasons = []
+    if bandwidth_budget is not None:
+        budget_kbps = f"{bandwidth_budget / 1e3:.0f} kbps"
+        within_budget = [c for c in candidates if c[1] <= bandwidth_budget]
+        if not within_budget:
+            probe = min(candidates, key=lambda c: c[1])[0]
+            return probe, (
+                f"no variant fits the bandwidth budget of {budget_kbps}; "
+                f"selected the lowest bitrate"
+            )
+        candidates = within_budget
+        reasons.append(f"within the bandwidth budget of {budget_kbps}")
+    if deadline is not None:
+        in_time = [c for c in candidates if c[2] <= deadline]
+        if not in_time:
+            probe, _, estimate = min(candidates, key=lambda c: c[2])
+            return probe, (
+                f"no variant can be downloaded within the deadline of "
+                f"{deadline:.0f}s; selected the fastest (~{estimate:.0f}s)"
+            )
+        candidates = in_time
+        reasons.append(f"estimated to download within the deadline of {deadline:.0f}s")
+    if not reasons:
+        reasons.append("with no constraints")
+    return candidates[0][0], "best variant " + " and ".join(reasons)
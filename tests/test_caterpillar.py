@@ -53,6 +53,26 @@ class TestCaterpillar(object):
         try_extention("mov")
         try_extention("flv")
 
+    @pytest.mark.parametrize("output_mode", ["fragmented", "plain"])
+    def test_output_mode(self, hls_server, monkeypatch, output_mode):
+        monkeypatch.setattr(
+            sys,
+            "argv",
+            ["-", "--output-mode", output_mode, hls_server.good_playlist],
+        )
+        assert caterpillar.main() == 0
+        assert os.path.isfile("good.mp4")
+        assert not os.path.exists("good")
+
+    @pytest.mark.parametrize("mode", ["0", "1"])
+    def test_stream_merge(self, hls_server, monkeypatch, mode):
+        monkeypatch.setattr(
+            sys, "argv", ["-", "--stream-merge", "-m", mode, hls_server.good_playlist]
+        )
+        assert caterpillar.main() == 0
+        assert os.path.isfile("good.mp4")
+        assert not os.path.exists("good")
+
     def test_overwrite(self, hls_server, monkeypatch):
         monkeypatch.setattr(sys, "argv", ["-", hls_server.good_playlist])
         assert caterpillar.main() == 0
@@ -103,6 +123,7 @@ class TestCaterpillar(object):
                 EventType.SEGMENTS_DOWNLOAD_INITIATED,
                 EventType.SEGMENT_DOWNLOAD_SUCCEEDED,
                 EventType.SEGMENTS_DOWNLOAD_FINISHED,
+                EventType.MERGE_PROGRESS,
                 EventType.MERGE_FINISHED,
             ]
         )
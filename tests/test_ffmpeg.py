@@ -0,0 +1,34 @@
+from caterpillar import ffmpeg
+from caterpillar.utils import FFmpegLogLevel
+
+
+class TestFFmpeg(object):
+    def test_log_entry_get_loglevel(self):
+        get_loglevel = ffmpeg.log_entry_get_loglevel
+        assert get_loglevel(b"[info] Press [q] to stop\n") == FFmpegLogLevel.info
+        assert (
+            get_loglevel(b"[hls @ 0x7fc93081d600] [verbose] Skip ('#EXT-X-VERSION:3')")
+            == FFmpegLogLevel.verbose
+        )
+        assert get_loglevel(b"[mp4 @ 0x7f] Non-monotonous DTS\n") is None
+        assert get_loglevel(b"frame=  100 fps=0.0\n") is None
+
+    def test_parse_progress_report(self):
+        progress = ffmpeg.parse_progress_report(
+            {"total_size": "1048576", "out_time_us": "2500000", "speed": "12.5x"},
+            elapsed=1.0,
+            finished=True,
+        )
+        assert progress.total_size == 1048576
+        assert progress.out_time == 2.5
+        assert progress.speed == 12.5
+        assert progress.finished
+
+        progress = ffmpeg.parse_progress_report(
+            {"total_size": "N/A", "out_time_us": "N/A", "speed": "N/A"},
+            elapsed=0.1,
+            finished=False,
+        )
+        assert progress.total_size is None
+        assert progress.out_time is None
+        assert progress.speed is None
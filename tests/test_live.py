@@ -0,0 +1,107 @@
+import http.server
+import pathlib
+import threading
+
+import pytest
+
+from caterpillar.live import LiveRecorder
+from caterpillar.playlist import load_playlist, parse_playlist
+
+
+pytestmark = pytest.mark.usefixtures("chtmpdir")
+
+
+# A live stream with a sliding window of 3 one-second segments. The
+# playlist advances by one segment every other request (so that every
+# other poll is answered with 304 Not Modified), and ends after
+# segment_count segments.
+class LiveHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *_):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if self.path.endswith(".ts"):
+            server.segment_requests.append(self.path)
+            self._respond(200, b"\0" * 188)
+            return
+        server.playlist_requests += 1
+        head = min(server.playlist_requests // 2 + 3, server.segment_count)
+        etag = f'"{head}"'
+        if self.headers.get("If-None-Match") == etag:
+            server.not_modified_count += 1
+            self._respond(304, b"", etag=etag)
+            return
+        first = max(head - 3, 0)
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-TARGETDURATION:1",
+            f"#EXT-X-MEDIA-SEQUENCE:{first}",
+        ]
+        for i in range(first, head):
+            lines += ["#EXTINF:1.0,", f"{i}.ts"]
+        if head == server.segment_count:
+            lines.append("#EXT-X-ENDLIST")
+        self._respond(200, "\n".join(lines).encode(), etag=etag)
+
+    def _respond(self, code, body, etag=None):
+        self.send_response(code)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture()
+def server():
+    httpd = http.server.HTTPServer(("127.0.0.1", 0), LiveHandler)
+    httpd.segment_count = 6
+    httpd.playlist_requests = 0
+    httpd.not_modified_count = 0
+    httpd.segment_requests = []
+    host, port = httpd.socket.getsockname()
+    httpd.playlist_url = f"http://{host}:{port}/live.m3u8"
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield httpd
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+class TestLiveRecorder(object):
+    def test_record(self, server):
+        remote_m3u8_file = pathlib.Path("remote.m3u8")
+        local_m3u8_file = pathlib.Path("local.m3u8")
+        server.playlist_requests = -1
+        initial = parse_playlist(
+            "#EXTM3U\n#EXT-X-TARGETDURATION:1\n#EXT-X-MEDIA-SEQUENCE:0\n"
+            "#EXTINF:1.0,\n0.ts\n#EXTINF:1.0,\n1.ts\n"
+        )
+        recorder = LiveRecorder(
+            server.playlist_url, remote_m3u8_file, local_m3u8_file, jobs=2
+        )
+        assert recorder.record(initial)
+
+        local = load_playlist(local_m3u8_file)
+        assert local.endlist
+        assert [s.uri for s in local.segments] == [f"{i}.ts" for i in range(6)]
+        # Each segment is downloaded exactly once.
+        assert sorted(server.segment_requests) == [f"/{i}.ts" for i in range(6)]
+        assert server.not_modified_count > 0
+
+    def test_stop(self, server):
+        server.segment_count = 1000
+        recorder = LiveRecorder(
+            server.playlist_url, pathlib.Path("remote.m3u8"), pathlib.Path("local.m3u8")
+        )
+        initial = parse_playlist("#EXTM3U\n#EXT-X-TARGETDURATION:1\n#EXTINF:1.0,\n0.ts\n")
+        timer = threading.Timer(2.5, recorder.stop)
+        timer.start()
+        assert recorder.record(initial)
+        timer.join()
+        local = load_playlist("local.m3u8")
+        assert local.endlist
+        assert 0 < len(local.segments) < 10
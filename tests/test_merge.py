@@ -0,0 +1,104 @@
+import json
+import pathlib
+
+import pytest
+
+from caterpillar import merge
+from caterpillar.merge import MergeCheckpoint, PartitionPlanner
+from caterpillar.playlist import load_playlist
+from caterpillar.utils import generate_m3u8
+
+
+pytestmark = pytest.mark.usefixtures("chtmpdir")
+
+
+@pytest.fixture()
+def playlist():
+    path = pathlib.Path("local.m3u8")
+    with open(path, "w", encoding="utf-8") as fp:
+        fp.write(generate_m3u8(10, [(f"{i}.ts", 10.0) for i in range(10)]))
+    return path
+
+
+def write_partition(index, size):
+    intermediate_dir = pathlib.Path("intermediate")
+    intermediate_dir.mkdir(exist_ok=True)
+    output = intermediate_dir / f"{index}.mp4"
+    with open(output, "wb") as fp:
+        fp.write(b"\0" * size)
+    return output
+
+
+class TestMergeCheckpoint(object):
+    def test_roundtrip(self, playlist):
+        path = pathlib.Path("intermediate/checkpoint.json")
+        checkpoint = MergeCheckpoint.load(path, playlist)
+        assert checkpoint.next_segment == 0
+        checkpoint.record(1, 0, 4, write_partition(1, 100))
+        checkpoint.record(2, 4, 7, write_partition(2, 200))
+
+        checkpoint = MergeCheckpoint.load(path, playlist)
+        assert [(p["start"], p["end"]) for p in checkpoint.partitions] == [
+            (0, 4),
+            (4, 7),
+        ]
+        assert checkpoint.next_segment == 7
+
+    def test_invalid_partition_truncates(self, playlist):
+        path = pathlib.Path("intermediate/checkpoint.json")
+        checkpoint = MergeCheckpoint.load(path, playlist)
+        checkpoint.record(1, 0, 4, write_partition(1, 100))
+        checkpoint.record(2, 4, 7, write_partition(2, 200))
+        checkpoint.record(3, 7, 10, write_partition(3, 300))
+        # Simulate a partition that was being rewritten when killed.
+        write_partition(2, 50)
+
+        checkpoint = MergeCheckpoint.load(path, playlist)
+        assert len(checkpoint.partitions) == 1
+        assert checkpoint.next_segment == 4
+
+    def test_playlist_mismatch(self, playlist):
+        path = pathlib.Path("intermediate/checkpoint.json")
+        checkpoint = MergeCheckpoint.load(path, playlist)
+        checkpoint.record(1, 0, 10, write_partition(1, 100))
+        with open(playlist, "w", encoding="utf-8") as fp:
+            fp.write(generate_m3u8(10, [(f"{i}.ts", 10.0) for i in range(11)]))
+
+        checkpoint = MergeCheckpoint.load(path, playlist)
+        assert not checkpoint.partitions
+        with open(path, encoding="utf-8") as fp:
+            assert len(json.load(fp)["partitions"]) == 1
+
+
+class TestPartitionPlanner(object):
+    def test_ranges(self, playlist, monkeypatch):
+        # Pretend DTS jumps at 3.ts and 7.ts.
+        attempts = []
+
+        def attempt_merge(m3u8_file, output, ignore_errors=False, **kwargs):
+            segments = [seg.uri for seg in load_playlist(m3u8_file).segments]
+            assert segments == [seg.uri for seg in kwargs["m3u8_obj"].segments]
+            attempts.append((segments[0], segments[-1], ignore_errors))
+            if not ignore_errors:
+                for bad in ("3.ts", "7.ts"):
+                    if bad in segments[1:]:
+                        return bad
+            return None
+
+        monkeypatch.setattr(merge, "attempt_merge", attempt_merge)
+        planner = PartitionPlanner(load_playlist(playlist), pathlib.Path("."))
+        ranges = []
+        start = 0
+        while start < planner.segment_count:
+            output = pathlib.Path(f"{len(ranges) + 1}.mp4")
+            end = planner.merge_partition(len(ranges) + 1, start, output)
+            ranges.append((start, end))
+            start = end
+        assert ranges == [(0, 3), (3, 7), (7, 10)]
+        assert attempts == [
+            ("0.ts", "9.ts", False),
+            ("0.ts", "2.ts", True),
+            ("3.ts", "9.ts", False),
+            ("3.ts", "6.ts", True),
+            ("7.ts", "9.ts", False),
+        ]
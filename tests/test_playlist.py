@@ -0,0 +1,83 @@
+import pytest
+
+from caterpillar.playlist import parse_playlist
+
+
+MEDIA_PLAYLIST = """\
+#EXTM3U
+#EXT-X-VERSION:4
+#EXT-X-TARGETDURATION:10
+#EXT-X-MEDIA-SEQUENCE:7
+#EXT-X-PLAYLIST-TYPE:VOD
+#EXTINF:9.009,
+first.ts
+#EXTINF:9.009,title
+#EXT-X-BYTERANGE:1000@500
+all.ts
+#EXTINF:3.003,
+#EXT-X-BYTERANGE:200
+all.ts
+#EXT-X-DISCONTINUITY
+#EXTINF:10,
+http://example.com/last.ts
+#EXT-X-ENDLIST
+"""
+
+MASTER_PLAYLIST = """\
+#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=1280000,AVERAGE-BANDWIDTH=1000000,CODECS="avc1.4d401f,mp4a.40.2"
+low.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2560000,RESOLUTION=1280x720
+mid.m3u8
+"""
+
+
+class TestParsePlaylist(object):
+    def test_media_playlist(self):
+        playlist = parse_playlist(MEDIA_PLAYLIST)
+        assert not playlist.is_variant
+        assert playlist.target_duration == 10
+        assert playlist.media_sequence == 7
+        assert playlist.playlist_type == "VOD"
+        assert playlist.endlist
+        assert [s.uri for s in playlist.segments] == [
+            "first.ts",
+            "all.ts",
+            "all.ts",
+            "http://example.com/last.ts",
+        ]
+        assert [s.duration for s in playlist.segments] == [9.009, 9.009, 3.003, 10.0]
+        assert [s.byterange for s in playlist.segments] == [
+            None,
+            (1000, 500),
+            (200, 1500),
+            None,
+        ]
+        assert [s.discontinuity for s in playlist.segments] == [
+            False,
+            False,
+            False,
+            True,
+        ]
+
+    def test_master_playlist(self):
+        playlist = parse_playlist(MASTER_PLAYLIST)
+        assert playlist.is_variant
+        low, mid = playlist.variants
+        assert low.uri == "low.m3u8"
+        assert low.bandwidth == 1280000
+        assert low.average_bandwidth == 1000000
+        assert low.codecs == "avc1.4d401f,mp4a.40.2"
+        assert low.resolution is None
+        assert mid.resolution == (1280, 720)
+
+    def test_slice_and_dump_roundtrip(self):
+        playlist = parse_playlist(MEDIA_PLAYLIST)
+        part = parse_playlist(playlist.slice(1, 3).dumps())
+        assert [s.uri for s in part.segments] == ["all.ts", "all.ts"]
+        assert [s.duration for s in part.segments] == [9.009, 3.003]
+        assert part.target_duration == 10
+
+    def test_malformed(self):
+        with pytest.raises(ValueError):
+            parse_playlist("#EXTM3U\n#EXTINF:abc,\n0.ts\n")
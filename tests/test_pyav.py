@@ -0,0 +1,60 @@
+import fractions
+import pathlib
+
+import pytest
+
+from caterpillar import pyav
+from caterpillar.merge import MergeCheckpoint
+from caterpillar.playlist import load_playlist
+from caterpillar.utils import generate_m3u8
+
+
+av = pytest.importorskip("av")
+
+pytestmark = pytest.mark.usefixtures("chtmpdir")
+
+
+# Encode a one-second MPEG-TS segment whose frames start at start_frame.
+#
+# start_frame should be positive so that the muxer doesn't shift
+# timestamps to avoid a negative DTS.
+def make_segment(path, start_frame, rate=25):
+    with av.open(str(path), "w", format="mpegts") as container:
+        stream = container.add_stream("mpeg2video", rate=rate)
+        stream.width = 64
+        stream.height = 64
+        stream.pix_fmt = "yuv420p"
+        for n in range(rate):
+            frame = av.VideoFrame(64, 64, "yuv420p")
+            frame.pts = start_frame + n
+            frame.time_base = fractions.Fraction(1, rate)
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+
+
+def remux(start_frames):
+    for index, start_frame in enumerate(start_frames):
+        make_segment(f"{index}.ts", start_frame)
+    playlist = pathlib.Path("local.m3u8")
+    with open(playlist, "w", encoding="utf-8") as fp:
+        fp.write(generate_m3u8(1, [(f"{i}.ts", 1.0) for i in range(len(start_frames))]))
+    intermediate_dir = pathlib.Path("intermediate")
+    intermediate_dir.mkdir(exist_ok=True)
+    checkpoint = MergeCheckpoint.load(intermediate_dir / "checkpoint.json", playlist)
+    pyav.remux_partitions(
+        load_playlist(playlist), pathlib.Path("."), intermediate_dir, checkpoint
+    )
+    return [(p["start"], p["end"]) for p in checkpoint.partitions]
+
+
+class TestPyAV(object):
+    def test_continuous(self):
+        assert remux([25, 50, 75, 100]) == [(0, 4)]
+        with av.open("intermediate/1.mp4") as container:
+            assert sum(1 for _ in container.demux(video=0)) >= 100
+
+    def test_dts_regression(self):
+        assert remux([25, 50, 25, 50, 75]) == [(0, 2), (2, 5)]
+        assert pathlib.Path("intermediate/2.mp4").stat().st_size > 0
@@ -0,0 +1,141 @@
+import http.server
+import os
+import pathlib
+import threading
+
+import pytest
+
+from caterpillar import persistence
+from caterpillar.caterpillar import download_m3u8_file_and_resolve_variants
+
+
+pytestmark = pytest.mark.usefixtures("chtmpdir")
+
+
+MASTER_PLAYLIST = """\
+#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=500000,RESOLUTION=640x360
+low.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=1000000,RESOLUTION=1280x720
+high.m3u8
+"""
+
+MEDIA_PLAYLIST = """\
+#EXTM3U
+#EXT-X-TARGETDURATION:10
+#EXTINF:10,
+{name}-0.ts
+#EXTINF:10,
+{name}-1.ts
+#EXT-X-ENDLIST
+"""
+
+SEGMENT_SIZES = {"low": 10000, "high": 100000}
+
+
+class RecordingHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *_):
+        pass
+
+    def send_response(self, code, message=None):
+        self.server.requests.append((self.path, code))
+        super().send_response(code, message)
+
+
+# Serves the current directory.
+@pytest.fixture()
+def server():
+    with open("master.m3u8", "w", encoding="utf-8") as fp:
+        fp.write(MASTER_PLAYLIST)
+    for name, size in SEGMENT_SIZES.items():
+        with open(f"{name}.m3u8", "w", encoding="utf-8") as fp:
+            fp.write(MEDIA_PLAYLIST.format(name=name))
+        for i in range(2):
+            with open(f"{name}-{i}.ts", "wb") as fp:
+                fp.write(b"\0" * size)
+
+    httpd = http.server.HTTPServer(("127.0.0.1", 0), RecordingHandler)
+    httpd.requests = []
+    host, port = httpd.socket.getsockname()
+    httpd.root_url = f"http://{host}:{port}/"
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield httpd
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@pytest.fixture()
+def database(monkeypatch):
+    monkeypatch.setattr(persistence, "CACHING_DISABLED", False)
+    monkeypatch.setattr(persistence, "_database_initialized", False)
+    persistence.initialize_database(pathlib.Path("data.db").resolve())
+    yield
+    persistence.database.close()
+
+
+def resolve(server, workdir, **kwargs):
+    os.makedirs(workdir)
+    server.requests.clear()
+    return download_m3u8_file_and_resolve_variants(
+        server.root_url + "master.m3u8", pathlib.Path(workdir) / "remote.m3u8", **kwargs
+    )
+
+
+class TestVariantSelectionCache(object):
+    def test_cache_and_revalidate(self, server, database):
+        url, file, m3u8_obj = resolve(server, "job1")
+        assert url == server.root_url + "high.m3u8"
+        assert file.name == "remote.variant.m3u8"
+        assert len(m3u8_obj.segments) == 2
+        assert server.requests == [("/master.m3u8", 200), ("/high.m3u8", 200)]
+
+        # Fresh selection: the master playlist isn't requested at all.
+        url, _, _ = resolve(server, "job2")
+        assert url == server.root_url + "high.m3u8"
+        assert server.requests == [("/high.m3u8", 200)]
+
+        # Stale selection: revalidated with a conditional GET.
+        persistence.VariantSelection.update(validated_at=0).execute()
+        url, _, _ = resolve(server, "job3")
+        assert url == server.root_url + "high.m3u8"
+        assert server.requests == [("/master.m3u8", 304), ("/high.m3u8", 200)]
+
+    def test_prefetch_fallback(self, server, database, monkeypatch):
+        monkeypatch.setattr("time.sleep", lambda _: None)  # Skip retry backoff
+        os.unlink("high.m3u8")
+        url, file, _ = resolve(server, "job1", prefetch_variants=2)
+        assert url == server.root_url + "low.m3u8"
+        assert file.name == "remote.variant.m3u8"
+        assert ("/low.m3u8", 200) in server.requests
+        assert not list(pathlib.Path("job1").glob("*.candidate*"))
+
+        # The fallback is what gets cached.
+        url, _, _ = resolve(server, "job2")
+        assert url == server.root_url + "low.m3u8"
+        assert server.requests == [("/low.m3u8", 200)]
+
+
+class TestVariantProbing(object):
+    def test_bandwidth_budget(self, server):
+        # low is 8 kbps, high is 80 kbps.
+        url, file, _ = resolve(
+            server, "job", variant_policy="probe", bandwidth_budget=20e3
+        )
+        assert url == server.root_url + "low.m3u8"
+        assert ("/low-0.ts", 200) in server.requests
+        assert ("/high-0.ts", 200) in server.requests
+
+        # The selection is pinned for resumed jobs.
+        server.requests.clear()
+        url, _, _ = download_m3u8_file_and_resolve_variants(
+            server.root_url + "master.m3u8", file.with_name("remote.m3u8")
+        )
+        assert url == server.root_url + "low.m3u8"
+        assert not server.requests
+
+    def test_deadline(self, server):
+        url, _, _ = resolve(server, "job", variant_policy="probe", deadline=3600)
+        assert url == server.root_url + "high.m3u8"